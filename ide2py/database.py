@@ -8,39 +8,370 @@ __copyright__ = "Copyright (C) 2014 Mariano Reingart"
 __license__ = "GPL 3.0"
 
 
+import logging
 import os
+import Queue
 import sqlite3
+import sys
+import thread
+import threading
+import time
 import UserDict
+import weakref
+from contextlib import contextmanager
 
 
-DEBUG = True
+log = logging.getLogger(__name__)  # diagnostic messages (Profiler for SQL)
 SQL_TYPE_MAP = {int: "INTEGER", float: "REAL", str: "TEXT", bool: "BOOLEAN"}
+AGGREGATE_MAP = {sum: 'sum', len: 'count', min: 'min', max: 'max'}
+BASIC_TYPES = tuple(SQL_TYPE_MAP.keys())
+ALL_TYPES = BASIC_TYPES + tuple(AGGREGATE_MAP.keys())
+OPERATOR_MAP = {'eq': "=", 'ne': "<>", 'lt': "<", 'le': "<=", 'gt': ">", 
+                'ge': ">=", 'like': "LIKE", 'in': "IN"}
+SRC_FILE = os.path.normcase(os.path.splitext(__file__)[0])
+MISSING = object()          # marker for the values not fetched (Record)
+
+
+class Profiler():
+    "Collect statistics of the executed statements (timing, rows, callers)"
+
+    def __init__(self, slow=0.1, explain=True):
+        self.slow = slow                # seconds to consider a query as slow
+        self.explain = explain          # capture the query plan of slow ones
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        "Clear all the counters"
+        self.started = time.time()
+        self.statements = {}    # {sql: [count, total time, max time, rows]}
+        self.callers = {}       # {(filename, lineno, function): [count, time]}
+        self.plans = {}         # {sql: [query plan details]} (slow ones)
+
+    def caller(self):
+        "Return the call site (first frame outside this module)"
+        frame = sys._getframe(2)
+        while frame:
+            code = frame.f_code
+            if os.path.normcase(os.path.splitext(code.co_filename)[0]) != SRC_FILE:
+                return (code.co_filename, frame.f_lineno, code.co_name)
+            frame = frame.f_back
+        return ("<%s>" % threading.current_thread().name, 0, "")
+
+    def record(self, sql, elapsed, rows, caller):
+        "Update the counters for an executed statement"
+        with self.lock:
+            stats = self.statements.setdefault(sql, [0, 0.0, 0.0, 0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+            stats[3] += max(rows, 0)
+            stats = self.callers.setdefault(caller, [0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+
+    def add_rows(self, sql, rows):
+        "Count the rows fetched later (streaming queries)"
+        with self.lock:
+            self.statements[sql][3] += rows
+
+    def report(self, limit=20):
+        "Return a text summary (most expensive statements and callers)"
+        lines = ["Database statistics (%d seconds):" % (time.time() - 
+                                                        self.started)]
+        with self.lock:
+            statements = sorted(self.statements.items(), 
+                                key=lambda item: -item[1][1])
+            callers = sorted(self.callers.items(), key=lambda item: -item[1][1])
+            plans = dict(self.plans)
+        lines.append("")
+        lines.append("%8s %10s %10s %8s  %s" % ("count", "total ms", "max ms", 
+                                                "rows", "statement"))
+        for sql, (count, total, max_time, rows) in statements[:limit]:
+            lines.append("%8d %10.2f %10.2f %8d  %s" % (count, total * 1000, 
+                         max_time * 1000, rows, " ".join(sql.split())))
+            for detail in plans.get(sql, []):
+                lines.append("%40s  %s" % ("plan:", detail))
+        lines.append("")
+        lines.append("%8s %10s  %s" % ("count", "total ms", "call site"))
+        for (filename, lineno, function), (count, total) in callers[:limit]:
+            lines.append("%8d %10.2f  %s:%s %s" % (count, total * 1000, 
+                         os.path.basename(filename), lineno, function))
+        return "\n".join(lines)
+
+    def dump(self, filename, limit=100):
+        "Write the text summary to a file"
+        f = open(filename, "w")
+        try:
+            f.write(self.report(limit))
+            f.write("\n")
+        finally:
+            f.close()
 
 
 class Database():
-    "Simple database abstraction layer"
+    "Simple database abstraction layer (thread-safe)"
     
-    def __init__(self, path, **kwargs):
-        self.cnn = sqlite3.connect(path)
-        self.cnn.row_factory = sqlite3.Row
+    def __init__(self, path, timeout=5.0, write_interval=None, 
+                       write_queue_size=1000, profile=False, slow_query=0.1,
+                       profile_file=None, **kwargs):
+        self.path = path
+        self.timeout = float(timeout)   # seconds to wait for a locked db
+        self.local = threading.local()  # connection and state per thread
+        self.shared_cnn = None          # in-memory database (see connect)
         self.primary_keys = {}
-        self.cur = None
-    
+        self.sql_cache = {}         # {(operation, table, fields): sql text}
+        # alive records (the same Row is returned for repeated accesses):
+        self.identity_map = weakref.WeakValueDictionary() # {(table, pk): Row}
+        self.search_tables = {}     # {table: (fts module, indexed fields)}
+        self.record_classes = {}    # {table: Record subclass (schema)}
+        # instrumentation hook (statistics of each statement executed):
+        self.profiler = None
+        if str(profile).lower() in ("1", "true", "yes", "on"):
+            self.profiler = Profiler(float(slow_query))
+        self.profile_file = profile_file    # dump the statistics at shutdown
+        self.connect()
+        # write the changes in a background thread (if an interval is given):
+        self.writer = None
+        if write_interval and path == ":memory:":
+            raise ValueError("Background writer needs a database file")
+        if write_interval:
+            self.writer = Writer(self, float(write_interval), 
+                                 int(write_queue_size))
+            self.writer.start()
+
+    def connect(self):
+        "Return the connection state of the current thread (open if needed)"
+        local = self.local
+        if getattr(local, "cnn", None) is None:
+            if self.path == ":memory:":
+                # each connection would be a new empty database, share it
+                # (note that the threads will share the transaction too)
+                if self.shared_cnn is None:
+                    self.shared_cnn = sqlite3.connect(self.path, 
+                                                      check_same_thread=False)
+                    self.shared_cnn.row_factory = sqlite3.Row
+                cnn = self.shared_cnn
+            else:
+                cnn = sqlite3.connect(self.path, timeout=self.timeout)
+                cnn.row_factory = sqlite3.Row
+                # readers don't block writers (nor vice versa) on WAL mode
+                cnn.execute("PRAGMA journal_mode=WAL")
+                cnn.execute("PRAGMA synchronous=NORMAL")
+            local.cnn = cnn
+            local.cur = None
+            # unit of work: pending changes to be written in batch on flush
+            local.new_rows = {}          # {table: [fields dict, ...]}
+            local.dirty_rows = {}        # {table: {pk value: fields dict}}
+            local.depth = 0              # nested transaction blocks
+        return local
+
     def cursor(self, force=False):
         "Instantiate a new (if needed) cursor to execute SQL queries"
-        if not self.cur or force:
-            self.cur = self.cnn.cursor()
-        return self.cur
+        local = self.connect()
+        if not local.cur or force:
+            local.cur = local.cnn.cursor()
+        return local.cur
+
+    def run(self, cur, sql, values=(), many=False, fetch=False):
+        "Execute a statement (recording its statistics if profiling)"
+        profiler = self.profiler
+        if profiler:
+            t0 = time.time()
+        if many:
+            cur.executemany(sql, values)
+        else:
+            cur.execute(sql, values)
+        ret = cur.fetchall() if fetch else cur
+        if profiler:
+            elapsed = time.time() - t0
+            rows = len(ret) if fetch else cur.rowcount
+            profiler.record(sql, elapsed, rows, profiler.caller())
+            if elapsed >= profiler.slow and profiler.explain and \
+               sql not in profiler.plans:
+                self.explain(sql, values[0] if many and values else values)
+        return ret
+
+    def explain(self, sql, values=()):
+        "Capture the query plan of a statement (stored in the profiler)"
+        try:
+            cur = self.connect().cnn.cursor()
+            cur.execute("EXPLAIN QUERY PLAN " + sql, values)
+            plan = [row[-1] for row in cur.fetchall()]
+            cur.close()
+        except sqlite3.Error, e:
+            plan = ["error: %s" % e]
+        if self.profiler:
+            self.profiler.plans[sql] = plan
+        return plan
+
+    def get_sql(self, operation, table, fields):
+        "Return the SQL text for the operation (cached by table and fields)"
+        key = (operation, table, fields)
+        sql = self.sql_cache.get(key)
+        if sql is not None:
+            return sql
+        if operation == "insert":
+            sql = "INSERT INTO %s (%s) VALUES (%s)" % (table, 
+                    ', '.join(fields), ', '.join(['?' for k in fields]))
+        elif operation == "update":
+            placemarks = ', '.join(["%s=?" % k for k in fields])
+            sql = "UPDATE %s SET %s WHERE %s_id = ?" % (table, placemarks, 
+                                                         table)
+        elif operation == "delete":
+            placemarks = ' AND '.join(["%s=?" % k for k in fields])
+            sql = "DELETE FROM %s WHERE %s" % (table, placemarks)
+        elif operation == "select":
+            # fields: (name, spec) pairs, spec is the filter / aggregate kind
+            where = ' AND '.join(["%s=?" % k for k, v in fields if v is None])
+            columns = ', '.join([(k if not v else "%s(%s)" % (v, k))
+                                 for k, v in fields 
+                                 if v is not None]) or "*"
+            if [v for k, v in fields if v]:
+                group_by = ', '.join([k for k, v in fields if not v])
+            else:
+                group_by = None
+            sql = "SELECT %s FROM %s" % (columns, table)
+            if where:
+                sql += " WHERE %s" % where
+            if group_by and columns != "*":
+                sql += " GROUP BY %s" % group_by
+        else:
+            raise ValueError("Unknown operation %s" % operation)
+        self.sql_cache[key] = sql
+        return sql
 
     def commit(self):
-        self.cnn.commit()
+        "End the transaction of the current thread (writing pending changes)"
+        self.flush()
+        local = self.connect()
+        if not local.depth:
+            # (inside a transaction block, it is committed at its end)
+            local.cnn.commit()
 
     def rollback(self):
-        self.cnn.rollback()
+        "Abort the transaction of the current thread"
+        # note that with the background writer, the statements outside a
+        # transaction block are already committed (use it to undo them)
+        local = self.connect()
+        # discard the pending changes too (they were never written)
+        local.new_rows = {}
+        local.dirty_rows = {}
+        local.cnn.rollback()
+
+    @contextmanager
+    def transaction(self):
+        "Run a block in a transaction (commit on success, else rollback)"
+        # the changes are written by this thread (not by the background
+        # writer) so they can be discarded if the block fails
+        local = self.connect()
+        if local.depth:
+            # nested block, the outer one will commit or rollback
+            yield self
+            return
+        if self.writer:
+            # write the previous changes first (to keep the order)
+            self.barrier()
+        local.depth += 1
+        try:
+            yield self
+        except:
+            local.depth -= 1
+            self.rollback()
+            raise
+        else:
+            try:
+                self.flush()        # pending rows written by this thread
+                local.cnn.commit()
+            finally:
+                local.depth -= 1
 
-    def create(self, table, _auto=True, **fields):
+    def close(self):
+        "Commit and close the connection of the current thread"
+        local = self.local
+        if getattr(local, "cnn", None) is not None:
+            self.commit()
+            if local.cnn is not self.shared_cnn:
+                local.cnn.close()
+            local.cnn = local.cur = None
+
+    def barrier(self):
+        "Wait until all the changes are written and committed (read-your-writes)"
+        self.flush()
+        if self.writer:
+            self.writer.barrier()
+
+    def prepare_read(self, *tables):
+        "Write the pending changes to the tables before querying them"
+        # note that if the changes were queued to the background writer, 
+        # the read has to wait until they are committed (read-your-writes)
+        self.flush()
+        if self.writer and not self.connect().depth and \
+           self.writer.pending(tables):
+            self.writer.barrier()
+
+    def shutdown(self):
+        "Write all the pending changes, stop the writer and dump statistics"
+        self.commit()
+        if self.writer:
+            self.writer.stop()
+            self.writer = None
+        if self.profiler and self.profile_file:
+            self.profiler.dump(self.profile_file)
+
+    def flush(self):
+        "Write all the pending changes, grouped by table and column set"
+        local = self.connect()
+        new_rows, dirty_rows = local.new_rows, local.dirty_rows
+        if not new_rows and not dirty_rows:
+            return 0
+        local.new_rows, local.dirty_rows = {}, {}
+        if self.writer and not local.depth:
+            # hand over the changes to the background thread (don't wait)
+            self.writer.put("rows", (new_rows, dirty_rows), 
+                            new_rows.keys() + dirty_rows.keys())
+            return sum([len(rows) for rows in new_rows.values()] + 
+                       [len(rows) for rows in dirty_rows.values()])
+        return self.write_rows(self.cursor(), new_rows, dirty_rows)
+
+    def write_rows(self, cur, new_rows, dirty_rows):
+        "Execute the batched inserts and updates (using the given cursor)"
+        count = 0
+        for table, rows in new_rows.items():
+            batches = {}
+            for data in rows:
+                fields = tuple(sorted(data))
+                batches.setdefault(fields, []).append([data[k] for k in fields])
+            for fields, values in batches.items():
+                sql = self.get_sql("insert", table, fields)
+                self.run(cur, sql, values, many=True)
+                count += len(values)
+        for table, rows in dirty_rows.items():
+            batches = {}
+            for key, data in rows.items():
+                if not data:
+                    continue
+                fields = tuple(sorted(data))
+                values = [data[k] for k in fields] + [key]
+                batches.setdefault(fields, []).append(values)
+            for fields, values in batches.items():
+                sql = self.get_sql("update", table, fields)
+                self.run(cur, sql, values, many=True)
+                count += len(values)
+        return count
+
+    def execute(self, sql, values, table=None):
+        "Run a write statement, return the last row id and the row count"
+        if self.writer and not self.connect().depth:
+            # keep the order with the queued changes (wait for the result)
+            return self.writer.execute(sql, values, table)
+        cur = self.run(self.cursor(), sql, values)
+        return cur.lastrowid, cur.rowcount
+
+    def create(self, table, _auto=True, _indexes=(), _unique=(), **fields):
         "Create a table in the database for the given name and fields dict"
-        cur = self.cnn.cursor()
+        # _indexes / _unique: list of field names (or tuples for compound keys)
+        cur = self.cursor()
         sql = []
         sql.append("CREATE TABLE IF NOT EXISTS %s (" % table)
         for i, (field_name, field_type) in enumerate(fields.items()):
@@ -62,76 +393,463 @@ class Database():
                 sql[-1] = sql[-1] + ","
         sql.append(");")
         sql = '\n'.join(sql)
-        cur.execute(sql)
+        self.run(cur, sql)
+        # add the indexes (also upgrading the already existing tables):
+        indexes = [(True, index) for index in _unique] + \
+                  [(False, index) for index in _indexes]
+        for field_name in sorted(fields):
+            if field_name.endswith("_id") and field_name != table + "_id":
+                indexes.append((False, field_name))
+        indexed = set()
+        for unique, index_fields in indexes:
+            if isinstance(index_fields, basestring):
+                index_fields = (index_fields, )
+            # skip foreign keys already covered by a (leading) index column
+            if index_fields[0] in indexed and len(index_fields) == 1:
+                continue
+            indexed.add(index_fields[0])
+            self.create_index(table, index_fields, unique)
+        # generate the compact record type for this table schema:
+        if table + "_id" in fields:
+            self.record_classes[table] = self.record_class(table, fields)
+
+    def record_class(self, table, fields):
+        "Create a Record subclass for the table (fixed fields positions)"
+        fields = tuple(sorted(fields))
+        attrs = {'__slots__': (), 'table_name': table, 'fields': fields,
+                 'index': dict([(k, i) for i, k in enumerate(fields)])}
+        return type("%sRecord" % str(table).title(), (Record, ), attrs)
+
+    def create_index(self, table, fields, unique=False):
+        "Create an index (if not exists) for the given table and fields list"
+        name = "%s_%s_%s" % (table, "_".join(fields), "uk" if unique else "ix")
+        sql = "CREATE %sINDEX IF NOT EXISTS %s ON %s (%s)" % (
+                    "UNIQUE " if unique else "", name, table, ", ".join(fields))
+        cur = self.cursor()
+        try:
+            self.run(cur, sql)
+        except sqlite3.IntegrityError, e:
+            # duplicated rows in an old database, fall back to a plain index
+            log.warning("Cannot create unique index %s: %s", name, e)
+            self.create_index(table, fields, unique=False)
 
-    def insert(self, table, **kwargs):
+    def insert(self, table, _defer=False, **kwargs):
         "Insert a row for the given values in the specified table"
-        items = kwargs.items()
-        fields = ', '.join([k for k, v in items])
-        placemarks = ', '.join(['?' for k, v in items])
-        sql = "INSERT INTO %s (%s) VALUES (%s)" % (table, fields, placemarks)
-        cur = self.cnn.cursor()
-        if DEBUG: print sql, [v for k, v in items]
-        cur.execute(sql, [v for k, v in items])
-        return cur.lastrowid
-
-    def update(self, table, **kwargs):
+        if _defer:
+            # write-behind: the new id will not be known until flush
+            self.connect().new_rows.setdefault(table, []).append(kwargs)
+            return None
+        self.flush()
+        fields = tuple(sorted(kwargs))
+        sql = self.get_sql("insert", table, fields)
+        values = [kwargs[k] for k in fields]
+        lastrowid, rowcount = self.execute(sql, values, table)
+        return lastrowid
+
+    def update(self, table, _defer=False, **kwargs):
         "Update rows using the given values (filter by primary key)"
-        items = kwargs.items()
         pk = table + "_id"
-        placemarks = ', '.join(["%s=?" % k for k, v in items if k != pk])
-        values = [v for k, v in items if k != pk] + [kwargs[pk]]
-        sql = "UPDATE %s SET %s WHERE %s = ?" % (table, placemarks, pk)
-        cur = self.cursor()
-        if DEBUG: print sql, values
-        cur.execute(sql, values)
-        return cur.rowcount
+        if _defer:
+            # write-behind: merge the changes with previous ones for this row
+            key = kwargs.pop(pk)
+            dirty_rows = self.connect().dirty_rows
+            dirty_rows.setdefault(table, {}).setdefault(key, {}).update(kwargs)
+            return None
+        self.flush()
+        fields = tuple(sorted([k for k in kwargs if k != pk]))
+        sql = self.get_sql("update", table, fields)
+        values = [kwargs[k] for k in fields] + [kwargs[pk]]
+        lastrowid, rowcount = self.execute(sql, values, table)
+        # refresh the cached record (if any), these values are the newest
+        row = self.identity_map.get((table, kwargs[pk]))
+        if row is not None:
+            row.refresh(kwargs, overwrite=True)
+        return rowcount
 
     def delete(self, table, **kwargs):
         "Delete rows (filter by given values)"
-        items = kwargs.items()
-        placemarks = ' AND '.join(["%s=?" % k for k, v in items])
-        values = [v for k, v in items]
-        sql = "DELETE FROM %s WHERE %s" % (table, placemarks)
-        cur = self.cursor()
-        cur.execute(sql, values)
-        return cur.rowcount
+        self.flush()
+        fields = tuple(sorted(kwargs))
+        sql = self.get_sql("delete", table, fields)
+        values = [kwargs[k] for k in fields]
+        lastrowid, rowcount = self.execute(sql, values, table)
+        self.invalidate(table, kwargs.get(table + "_id"))
+        return rowcount
 
     def select(self, table, **kwargs):
         "Query rows (filter by given values)"
-        items = kwargs.items()
-        basic_types = tuple(SQL_TYPE_MAP.keys())
-        aggregate_types = {sum: 'sum', len: 'count', min: 'min', max: 'max'}
-        all_types = basic_types + tuple(aggregate_types.keys())
-        where = ' AND '.join(["%s=?" % k for k, v in items
-                                         if v not in all_types])
-        fields = ', '.join([(k if v in basic_types 
-                               else "%s(%s)" % (aggregate_types[v], k))
-                            for k, v in items 
-                            if v in all_types]) or "*"
-        if [v for k, v in items if v in aggregate_types]:
-            group_by = ', '.join([k for k, v in items 
-                                    if not v in (aggregate_types.keys())])
-        else:
-            group_by = None
-        values = [v for k, v in items if v not in all_types]
-        sql = "SELECT %s FROM %s" % (fields, table)
-        if where:
-            sql += " WHERE %s" % where
-        if group_by and fields != "*":
-            sql += " GROUP BY %s" % group_by
+        self.prepare_read(table)
+        # classify the fields: filter value, column (type) or aggregate
+        fields = []
+        values = []
+        for k, v in sorted(kwargs.items()):
+            if v not in ALL_TYPES:
+                fields.append((k, None))
+                values.append(v)
+            elif v in BASIC_TYPES:
+                fields.append((k, ""))
+            else:
+                fields.append((k, AGGREGATE_MAP[v]))
+        sql = self.get_sql("select", table, tuple(fields))
+        return self.run(self.cursor(), sql, values, fetch=True)
+
+    def query(self, table, _fields=None, _join=(), _where=None, _order=None,
+              _limit=None, _offset=None, _size=100, **kwargs):
+        "Iterate over the rows (filter: field__op=value, order: [-]field)"
+        # _join: table names (or (table, field) to use other than table_id)
+        # _where: filters for the joined tables ("table.field__op": value)
+        if isinstance(_join, basestring):
+            _join = [_join]
+        self.prepare_read(table, *[join if isinstance(join, basestring) 
+                                   else join[0] for join in _join])
+        where = dict(_where or {})
+        for k, v in kwargs.items():
+            where["%s.%s" % (table, k)] = v
+        conditions = []
+        values = []
+        for k, v in sorted(where.items()):
+            field_name, sep, op = k.partition("__")
+            op = op or "eq"
+            if op == "in":
+                v = list(v)
+                conditions.append((field_name, op, len(v)))
+                values.extend(v)
+            elif v is None and op in ("eq", "ne"):
+                conditions.append((field_name, op, 0))  # IS [NOT] NULL
+            else:
+                conditions.append((field_name, op, 1))
+                values.append(v)
+        if _limit is not None or _offset is not None:
+            values.extend([-1 if _limit is None else _limit, _offset or 0])
+        if isinstance(_fields, basestring):
+            _fields = [_fields]
+        if isinstance(_order, basestring):
+            _order = [_order]
+        key = ("query", table, tuple(_fields or ()), tuple(_join), 
+               tuple(conditions), tuple(_order or ()), 
+               _limit is not None or _offset is not None)
+        sql = self.sql_cache.get(key)
+        if sql is None:
+            sql = "SELECT %s FROM %s" % (", ".join(_fields or ["*"]), table)
+            for join in _join:
+                if isinstance(join, basestring):
+                    join = (join, join + "_id")
+                sql += " JOIN %s ON %s.%s = %s.%s" % (join[0], join[0], join[1],
+                                                      table, join[1])
+            where = []
+            for field_name, op, count in conditions:
+                if op == "in":
+                    where.append("%s IN (%s)" % (field_name, 
+                                                 ", ".join(["?"] * count)))
+                elif not count:
+                    where.append("%s IS %sNULL" % (field_name, 
+                                                   "NOT " if op == "ne" else ""))
+                else:
+                    where.append("%s %s ?" % (field_name, OPERATOR_MAP[op]))
+            if where:
+                sql += " WHERE %s" % " AND ".join(where)
+            if _order:
+                order = []
+                for field_name in _order:
+                    desc = field_name.startswith("-")
+                    field_name = field_name.lstrip("+-")
+                    if "." not in field_name:
+                        field_name = "%s.%s" % (table, field_name)
+                    order.append(field_name + (" DESC" if desc else ""))
+                sql += " ORDER BY %s" % ", ".join(order)
+            if key[-1]:
+                sql += " LIMIT ? OFFSET ?"
+            self.sql_cache[key] = sql
+        # use a new cursor, so other queries could be run while iterating
+        cur = self.run(self.connect().cnn.cursor(), sql, values)
+        return self.fetch(cur, _size, sql)
+
+    def fetch(self, cur, size=100, sql=None):
+        "Yield the rows of an executed query (fetching them in blocks)"
+        while True:
+            rows = cur.fetchmany(size)
+            if not rows:
+                break
+            if self.profiler and sql:
+                self.profiler.add_rows(sql, len(rows))
+            for row in rows:
+                yield row
+        cur.close()
+
+    def create_search(self, table, *fields):
+        "Create a full-text index on the table fields (updated by triggers)"
+        fts = table + "_fts"
+        pk = table + "_id"
         cur = self.cursor()
-        if DEBUG: print sql, values
-        cur.execute(sql, values)
-        return cur.fetchall()
+        rows = self.run(cur, "SELECT sql FROM sqlite_master WHERE name=?", 
+                        [fts], fetch=True)
+        if rows:
+            module = "fts5" if "fts5" in rows[0][0].lower() else "fts4"
+        else:
+            # external content (the text is not duplicated), prefer FTS5:
+            try:
+                module = "fts5"
+                self.run(cur, "CREATE VIRTUAL TABLE %s USING fts5(%s, "
+                              "content=%s, content_rowid=%s)" % (fts, 
+                              ", ".join(fields), table, pk))
+            except sqlite3.OperationalError:
+                module = "fts4"
+                try:
+                    self.run(cur, "CREATE VIRTUAL TABLE %s USING fts4(%s, "
+                                  "content=%s)" % (fts, ", ".join(fields), 
+                                                   table))
+                except sqlite3.OperationalError, e:
+                    # sqlite compiled without full-text search (no search)
+                    log.warning("Cannot create search index %s: %s", fts, e)
+                    return False
+        columns = ", ".join(fields)
+        new_values = ", ".join(["new.%s" % k for k in fields])
+        old_values = ", ".join(["old.%s" % k for k in fields])
+        if module == "fts5":
+            insert = "INSERT INTO %s (rowid, %s) VALUES (new.%s, %s);" % (
+                            fts, columns, pk, new_values)
+            delete = "INSERT INTO %s (%s, rowid, %s) VALUES ('delete', " \
+                     "old.%s, %s);" % (fts, fts, columns, pk, old_values)
+            triggers = [("ai", "AFTER INSERT", insert), 
+                        ("ad", "AFTER DELETE", delete),
+                        ("au", "AFTER UPDATE OF %s" % columns, delete + insert)]
+        else:
+            insert = "INSERT INTO %s (docid, %s) VALUES (new.%s, %s);" % (
+                            fts, columns, pk, new_values)
+            delete = "DELETE FROM %s WHERE docid = old.%s;" % (fts, pk)
+            triggers = [("ai", "AFTER INSERT", insert), 
+                        ("bd", "BEFORE DELETE", delete),
+                        ("bu", "BEFORE UPDATE OF %s" % columns, delete),
+                        ("au", "AFTER UPDATE OF %s" % columns, insert)]
+        # only the text fields are tracked (not to slow down other updates)
+        for suffix, event, action in triggers:
+            self.run(cur, "CREATE TRIGGER IF NOT EXISTS %s_%s %s ON %s "
+                          "BEGIN %s END" % (fts, suffix, event, table, action))
+        if not rows:
+            # index the already existing records
+            self.run(cur, "INSERT INTO %s (%s) VALUES ('rebuild')" % (fts, fts))
+            self.commit()
+        self.search_tables[table] = (module, fields)
+        return True
+
+    def search(self, table, text, _limit=50, _raw=False, **kwargs):
+        "Full-text search, return the best rows (with rank and snippet)"
+        # text: words to look for (prefixes), _raw: use the FTS query syntax
+        self.prepare_read(table)
+        module, fields = self.search_tables[table]
+        fts = table + "_fts"
+        if not _raw:
+            # quote the words and look for prefixes (* syntax differs)
+            fmt = '"%s"*' if module == "fts5" else '"%s*"'
+            text = " ".join([fmt % word.replace('"', '""') 
+                             for word in text.split()])
+        filters = tuple(sorted(kwargs))
+        key = ("search", table, filters)
+        sql = self.sql_cache.get(key)
+        if sql is None:
+            if module == "fts5":
+                rank = "bm25(%s)" % fts
+                snippet = "snippet(%s, -1, '[', ']', '...', 10)" % fts
+            else:
+                # no ranking function on FTS4, approximate it by the matches
+                rank = "-length(offsets(%s))" % fts
+                snippet = "snippet(%s, '[', ']', '...', -1, 10)" % fts
+            sql = "SELECT %s.*, %s AS rank, %s AS snippet FROM %s " \
+                  "JOIN %s ON %s.%s_id = %s.rowid WHERE %s MATCH ?" % (
+                        table, rank, snippet, fts, table, table, table, fts, 
+                        fts)
+            for k in filters:
+                sql += " AND %s.%s = ?" % (table, k)
+            sql += " ORDER BY rank LIMIT ?"
+            self.sql_cache[key] = sql
+        values = [text] + [kwargs[k] for k in filters] + [_limit]
+        return self.run(self.cursor(), sql, values, fetch=True)
+
+    def get_row(self, table, key, data=None):
+        "Return the cached record for the primary key (or a new one)"
+        row = self.identity_map.get((table, key))
+        if row is None:
+            record_class = self.record_classes.get(table)
+            if record_class:
+                row = record_class(self, key)
+            else:
+                row = Row(self, table, {table + "_id": key})
+            self.identity_map[table, key] = row
+        if data is not None:
+            # refresh the fetched values (pending modifications are kept)
+            row.refresh(data)
+        return row
+
+    def invalidate(self, table, key=None):
+        "Discard the cached records (all the table if no key is given)"
+        if key is not None:
+            keys = [(table, key)]
+        else:
+            keys = [k for k in self.identity_map.keys() if k[0] == table]
+        for k in keys:
+            row = self.identity_map.pop(k, None)
+            if row is not None:
+                # force a reload on next access (the record may not exist)
+                row.invalidate()
 
     def __getitem__(self, table_name):
         "Return an intermediate accesor to the table (don't query the db yet)" 
         return Table(self, table_name)
 
     def __del__(self):
-        if DEBUG: print "Delayed COMMIT!"
-        self.commit()
+        if getattr(self.local, "cnn", None) is not None:
+            self.commit()
+
+
+class Writer(threading.Thread):
+    "Background thread to write and commit the changes periodically"
+
+    def __init__(self, db, interval=1.0, maxsize=1000):
+        threading.Thread.__init__(self, name="DatabaseWriter")
+        self.daemon = True
+        self.db = db
+        self.interval = interval            # seconds between commits
+        self.queue = Queue.Queue(maxsize)   # bounded (block if too busy)
+        self.lock = threading.Lock()        # keep the requests ordered
+        self.condition = threading.Condition()
+        self.submitted = 0                  # number of requests queued
+        self.committed = 0                  # number of requests done
+        self.tables = {}                    # {table: last request queued}
+        self.errors = {}                    # {thread id: write error}
+
+    def put(self, kind, args=(), tables=()):
+        "Queue a request, return its sequence number"
+        # tables: names of the modified tables (None if not known)
+        with self.lock:
+            self.submitted += 1
+            seq = self.submitted
+            for table in tables:
+                self.tables[table] = seq
+            self.queue.put((seq, kind, args, thread.get_ident()))
+        # report the failures of the previous changes queued by this thread
+        self.check()
+        return seq
+
+    def check(self):
+        "Raise the write error (if any) of the changes queued by this thread"
+        error = self.errors.pop(thread.get_ident(), None)
+        if error:
+            raise error
+
+    def pending(self, tables=None):
+        "Return True if there are changes not committed yet (to the tables)"
+        if tables is None:
+            return self.committed < self.submitted
+        for table in tuple(tables) + (None, ):
+            if self.tables.get(table, 0) > self.committed:
+                return True
+        return False
+
+    def wait(self, seq):
+        "Block until the request is done (re-raising any write error)"
+        with self.condition:
+            while self.committed < seq:
+                self.condition.wait()
+        self.check()
+
+    def barrier(self):
+        "Commit all the queued changes (on demand) and wait for them"
+        self.wait(self.put("commit"))
+
+    def execute(self, sql, values, table=None):
+        "Run a statement in order, return the last row id and row count"
+        result = {}
+        self.wait(self.put("execute", (sql, values, result), [table]))
+        if 'error' in result:
+            raise result['error']
+        return result['lastrowid'], result['rowcount']
+
+    def stop(self):
+        "Commit all the queued changes and end the thread"
+        self.wait(self.put("stop"))
+        self.join()
+
+    def write_each(self, cur, requests):
+        "Write the rows one at a time (reporting the failures to the owners)"
+        for owner, new_rows, dirty_rows in requests:
+            for table, rows in new_rows.items():
+                for data in rows:
+                    try:
+                        self.db.write_rows(cur, {table: [data]}, {})
+                    except sqlite3.Error, e:
+                        self.errors[owner] = e
+            for table, rows in dirty_rows.items():
+                for key, data in rows.items():
+                    try:
+                        self.db.write_rows(cur, {}, {table: {key: data}})
+                    except sqlite3.Error, e:
+                        self.errors[owner] = e
+
+    def run(self):
+        cur = self.db.cursor()
+        cnn = self.db.connect().cnn
+        new_rows, dirty_rows = {}, {}
+        requests = []           # [(owner, new rows, dirty rows)] merged
+        seq = 0
+        deadline = timer = None
+        while True:
+            # note that a timeout would poll the queue (slow wake up on py2)
+            seq, kind, args, owner = self.queue.get()
+            if kind == "rows":
+                # merge successive updates to the same row (last wins)
+                requests.append((owner, ) + args)
+                for table, rows in args[0].items():
+                    new_rows.setdefault(table, []).extend(rows)
+                for table, rows in args[1].items():
+                    table_rows = dirty_rows.setdefault(table, {})
+                    for key, data in rows.items():
+                        table_rows.setdefault(key, {}).update(data)
+                if deadline is None:
+                    deadline = time.time() + self.interval
+                    # request the periodic commit (see put)
+                    timer = threading.Timer(self.interval, self.put, 
+                                            ("commit", ))
+                    timer.daemon = True
+                    timer.start()
+                if time.time() < deadline:
+                    continue
+            try:
+                # write the previous changes first (to keep the order)
+                try:
+                    self.db.write_rows(cur, new_rows, dirty_rows)
+                except sqlite3.Error:
+                    # invalid row (i.e. duplicate), do not lose the others
+                    cnn.rollback()
+                    self.write_each(cur, requests)
+                if kind == "execute":
+                    sql, values, result = args
+                    try:
+                        self.db.run(cur, sql, values)
+                        result['lastrowid'] = cur.lastrowid
+                        result['rowcount'] = cur.rowcount
+                    except sqlite3.Error, e:
+                        result['error'] = e
+                cnn.commit()
+            except Exception, e:
+                # nothing was written, report it to the waiting threads
+                cnn.rollback()
+                for request in requests:
+                    self.errors[request[0]] = e
+                if kind == "execute":
+                    args[2]['error'] = e
+                elif owner is not None:
+                    self.errors[owner] = e
+            new_rows, dirty_rows = {}, {}
+            requests = []
+            deadline = None
+            if timer:
+                timer.cancel()
+                timer = None
+            with self.condition:
+                self.committed = seq
+                self.condition.notify_all()
+            if kind == "stop":
+                break
 
 
 class Table():
@@ -148,10 +866,13 @@ class Table():
 
     def __getitem__(self, key):
         "Return an intermediate accesor to the record (don't query the db yet)" 
-        return Row(self.db, self.table_name, {self.table_name + "_id": key})
+        return self.db.get_row(self.table_name, key)
 
     def __call__(self, **kwargs):
         "Return an intermediate accesor to the record (using kwargs as filter)" 
+        pk = self.table_name + "_id"
+        if kwargs.keys() == [pk]:
+            return self.db.get_row(self.table_name, kwargs[pk])
         return Row(self.db, self.table_name, query=kwargs)
     
     def new(self, **kwargs):
@@ -170,11 +891,24 @@ class Table():
 
     def select(self, **kwargs):
         "Short-cut to return a list of select rows (filter: fields values dict)"
+        pk = self.table_name + "_id"
         for r in self.db.select(self.table_name, **kwargs):
-            row = Row(self.db, self.table_name)
-            row.load(r)
+            if pk in r.keys():
+                row = self.db.get_row(self.table_name, r[pk], r)
+            else:
+                row = Row(self.db, self.table_name)
+                row.load(r)
             yield row
 
+    def query(self, **kwargs):
+        "Short-cut to iterate over the records (see Database.query)"
+        pk = self.table_name + "_id"
+        if kwargs.get('_join') and not kwargs.get('_fields'):
+            # do not mix the fields of the joined tables
+            kwargs['_fields'] = "%s.*" % self.table_name
+        for r in self.db.query(self.table_name, **kwargs):
+            yield self.db.get_row(self.table_name, r[pk], r)
+
 
 class Row():
     "Dict-like to map stored fields in the database" 
@@ -198,22 +932,56 @@ class Row():
             if not self.primary_key:
                 pk = self.table_name + "_id"
                 self.primary_key = self.query = {pk: self.data_in.get(pk)}
+                self.db.identity_map.setdefault((self.table_name, 
+                                                 self.data_in.get(pk)), self)
     
-    def save(self):
-        "Write the modified values to the database"
+    def refresh(self, data, overwrite=False):
+        "Merge the fetched (or just written, if overwrite) values"
+        if overwrite:
+            # these values are newer than the pending modifications
+            for k in data:
+                self.data_out.pop(k, None)
+        if self.data_in:
+            self.data_in.update(dict(data))
+        elif not overwrite:
+            self.load(data)
+
+    def invalidate(self):
+        "Forget the fetched values (reload them on next access)"
+        self.data_in = {}
+
+    def modified(self):
+        return bool(self.data_out)
+
+    def discard(self):
+        "Forget the pending modifications"
+        self.data_out = {}
+
+    def save(self, defer=False):
+        "Write the modified values to the database (queued if defer)"
         pk = self.table_name + "_id"
+        if self.data_out and not self.primary_key and self.query:
+            # inserted before (deferred): fetch the id to update that record
+            self.load()
         if not self.data_out:
             # no modification, abort any SQL
             new_id = None
         elif self.primary_key:
             self.data_out.update(self.primary_key)
-            self.db.update(self.table_name, **self.data_out)
+            self.db.update(self.table_name, _defer=defer, **self.data_out)
             new_id = self.primary_key.values()[0]
+        elif defer:
+            # batch insert, the record will be re-fetched (by value) if needed
+            self.db.insert(self.table_name, _defer=True, **self.data_out)
+            self.query = dict([(k, v) for k, v in self.data_out.items()
+                                      if v is not None])
+            new_id = None
         else:
             new_id = self.db.insert(self.table_name, **self.data_out)
             # store the new id so the record could be re-fetched on next access
             self.primary_key = self.query = {pk: new_id}
             self.data_in.update(self.primary_key)
+            self.db.identity_map[self.table_name, new_id] = self
         # assume data was written correctly and update internal cache:
         self.data_in.update(self.data_out)
         self.data_out = {}
@@ -244,6 +1012,9 @@ class Row():
         # real record should be in the database, fetch if necessary
         if not self.data_in:
             self.load()
+        elif field not in self.data_in and field not in self.data_out:
+            # partially fetched or deferred insert (id not known), refresh it
+            self.load()
         # return the most updated value (it could not reach the db yet)
         if field in self.data_out:
             return self.data_out[field]
@@ -279,51 +1050,230 @@ class Row():
         return len(self.data_in)
 
     def __contains__(self, key):
-        return key in self.data_in or field in self.data_out
+        return key in self.data_in or key in self.data_out
+
+
+class Record(object):
+    "Compact dict-like record (slotted, values in a list per table schema)"
+
+    __slots__ = ("db", "key", "values", "dirty", "__weakref__")
+    table_name = None       # class attributes (see Database.record_class)
+    fields = ()             # field names (sorted, position in values)
+    index = {}              # {field name: position}
+
+    def __init__(self, db, key):
+        self.db = db
+        self.key = key                              # primary key value
+        self.values = [MISSING] * len(self.fields)
+        self.values[self.index[self.table_name + "_id"]] = key
+        self.dirty = 0                              # modified fields bitmask
+
+    def load(self, data=None):
+        "Fetch the record from the database"
+        if not data:
+            rows = self.db.select(self.table_name, 
+                                  **{self.table_name + "_id": self.key})
+            data = rows and rows[0]
+        if data:
+            self.refresh(data)
+
+    def refresh(self, data, overwrite=False):
+        "Merge the fetched (or just written, if overwrite) values"
+        index = self.index
+        for k in data.keys():
+            i = index.get(k)
+            if i is None:
+                continue
+            if self.dirty & (1 << i):
+                if not overwrite:
+                    continue        # keep the pending modification
+                self.dirty &= ~(1 << i)
+            self.values[i] = data[k]
+
+    def invalidate(self):
+        "Forget the fetched values (reload them on next access)"
+        for i in range(len(self.values)):
+            if not self.dirty & (1 << i):
+                self.values[i] = MISSING
+
+    def modified(self):
+        return bool(self.dirty)
+
+    def discard(self):
+        "Forget the pending modifications"
+        for i in range(len(self.values)):
+            if self.dirty & (1 << i):
+                self.values[i] = MISSING
+        self.dirty = 0
+
+    def is_loaded(self):
+        pk = self.index[self.table_name + "_id"]
+        for i, v in enumerate(self.values):
+            if v is not MISSING and i != pk:
+                return True
+        return False
+
+    def save(self, defer=False):
+        "Write the modified values to the database (queued if defer)"
+        if not self.dirty:
+            # no modification, abort any SQL
+            return None
+        changes = {}
+        for i, k in enumerate(self.fields):
+            if self.dirty & (1 << i):
+                changes[k] = self.values[i]
+        changes[self.table_name + "_id"] = self.key
+        self.dirty = 0
+        self.db.update(self.table_name, _defer=defer, **changes)
+        return self.key
+
+    def keys(self):
+        if not self.is_loaded():
+            self.load()
+        return [k for k, v in zip(self.fields, self.values) if v is not MISSING]
+
+    def update(self, other):
+        # selective update: do not modify if value didn't changed
+        for k, v in other.items():
+            i = self.index[k]
+            if self.values[i] is MISSING or self.values[i] != v:
+                self.values[i] = v
+                self.dirty |= 1 << i
+
+    def get(self, field, default=None):
+        if field not in self.index:
+            return default      # not a column of this table
+        try:
+            return self.__getitem__(field)
+        except KeyError:
+            return default      # the record does not exist (anymore)
+
+    def copy(self):
+        return dict([(k, self[k]) for k in self.keys()])
+
+    def __getitem__(self, field):
+        "Read the field value for this record (fetch it if necessary)"
+        i = self.index[field]
+        value = self.values[i]
+        if value is MISSING:
+            self.load()
+            value = self.values[i]
+            if value is MISSING:
+                raise KeyError(field)
+        return value
+
+    def __setitem__(self, field, value):
+        "Store the field value for further update (at the destructor)"
+        i = self.index[field]
+        self.values[i] = value
+        self.dirty |= 1 << i
+
+    def __delitem__(self, field):
+        "Remove the field from the internal cache"
+        i = self.index[field]
+        if self.values[i] is MISSING:
+            raise KeyError(field)
+        self.values[i] = MISSING
+        self.dirty &= ~(1 << i)
+
+    def __del__(self):
+        "Write data to the database on destruction"
+        if self.dirty:
+            self.save()
+
+    def __nonzero__(self):
+        if not self.is_loaded():
+            self.load()
+        return self.is_loaded()
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __contains__(self, key):
+        i = self.index.get(key)
+        return i is not None and self.values[i] is not MISSING
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.key)
 
 
 class Shelf(UserDict.DictMixin):
     "Database shelve replacement implementation (dictionary-like object)"
 
     def __init__(self, db, table_name, key_field_name, **filters):
-        self.dict = {}
+        self.dict = {}              # fetched rows {key: Row}
+        self.primary_keys = {}      # stored records {key: id} (None if new)
+        self.dirty = set()          # keys of the rows accessed since sync
         self.db = db
         self.table_name = table_name
         self.key_field_name = key_field_name
         self.filters = filters
-        # populate the internal dictionary:
-        for r in self.db.select(self.table_name, **filters):
-            row = Row(self.db, self.table_name)
-            row.load(r)
-            self.dict[r[key_field_name]] = row
+        # only fetch the keys, the rows will be loaded on demand:
+        pk = table_name + "_id"
+        query = dict(filters)
+        query[key_field_name] = str
+        query[pk] = int
+        for r in self.db.select(self.table_name, **query):
+            self.primary_keys[r[key_field_name]] = r[pk]
+
+    def load(self):
+        "Fetch all the rows not loaded yet (in a single query)"
+        if len(self.dict) < len(self.primary_keys):
+            pk = self.table_name + "_id"
+            for r in self.db.select(self.table_name, **self.filters):
+                key = r[self.key_field_name]
+                if key not in self.dict:
+                    self.dict[key] = self.db.get_row(self.table_name, r[pk], r)
 
     def keys(self):
-        return self.dict.keys()
+        return self.primary_keys.keys()
+
+    def values(self):
+        self.load()
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        self.load()
+        return [(key, self[key]) for key in self.keys()]
 
     def __len__(self):
-        return len(self.dict)
+        return len(self.primary_keys)
 
     def has_key(self, key):
-        return key in self.dict
+        return key in self.primary_keys
 
     def __contains__(self, key):
-        return key in self.dict
+        return key in self.primary_keys
 
     def get(self, key, default=None):
-        if key in self.dict:
-            return self.dict[key]
+        if key in self.primary_keys:
+            return self[key]
         return default
 
     def __getitem__(self, key):
-        return self.dict[key]
+        row = self.dict.get(key)
+        if row is None:
+            # get the record proxy (it will not be queried until used)
+            row = self.db.get_row(self.table_name, self.primary_keys[key])
+            self.dict[key] = row
+        # the row could be modified by the caller, check it on next sync:
+        self.dirty.add(key)
+        return row
 
     def __setitem__(self, key, value):
-        # create a new Row proxy (value should be a dict!)
-        row = Row(self.db, self.table_name)
+        # value should be a dict!
         value.update(self.filters)
         value[self.key_field_name] = key
-        row.update(value)
-        self.dict[key] = row
+        if key in self.primary_keys:
+            # update the existing record (do not duplicate it)
+            self[key].update(value)
+        else:
+            # create a new Row proxy 
+            row = Row(self.db, self.table_name)
+            row.update(value)
+            self.dict[key] = row
+            self.primary_keys[key] = None
+            self.dirty.add(key)
         
     def setdefault(self, key, default=None):
         try:
@@ -333,25 +1283,47 @@ class Shelf(UserDict.DictMixin):
             return self[key]
 
     def __delitem__(self, key):
-        raise NotImplementedError
+        pk = self.table_name + "_id"
+        key_id = self.primary_keys.pop(key)
+        row = self.dict.pop(key, None)
+        self.dirty.discard(key)
+        if row is not None:
+            # discard any pending modification
+            row.discard()
+            if key_id is None and row.query:
+                # inserted in a previous sync, fetch the new id
+                key_id = row[pk]
+        if key_id is not None:
+            self.db.delete(self.table_name, **{pk: key_id})
 
     def close(self):
+        # check every row fetched (references could be kept by the caller)
+        self.dirty.update(self.dict.keys())
         self.sync()
 
     def __del__(self):
         self.close()
 
     def sync(self):
-        "Write back all the changes to the database" 
-        for row in self.dict.values():
-            row.save()
+        "Write back the changes to the database (only the modified rows)" 
+        for key in self.dirty:
+            row = self.dict.get(key)
+            if row is not None and row.modified():
+                row.save(defer=True)
+        self.dirty.clear()
         self.db.commit()
 
 
 if __name__ == "__main__":
-    db = Database(path="test.db")
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(prefix="rad2py-"), "test.db")
+    db = Database(path=path)
     t1 = db.create("t1", t1_id=int, f=float, s=str)
-    db.create("t2", t2_id=int, f=float, s=str, n=int, t1_id=int)
+    db.create("t2", t2_id=int, f=float, s=str, n=int, t1_id=int, 
+              _indexes=[("s", "n")])
+    indexes = [r['name'] for r in db.select("sqlite_master", type="index", 
+                                              name=str)]
+    assert "t2_s_n_ix" in indexes and "t2_t1_id_ix" in indexes
     id1 = db.insert("t1", f=3.14159265359, s="pi")
     id1 = db.insert("t1", f=2.71828182846, s="e")
     id2 = db.insert("t2", f=2.71828182846, s="e", t1_id=id1)
@@ -373,6 +1345,22 @@ if __name__ == "__main__":
     assert db['t1'][t1_id]['f'] == 2 
     assert not db['t1'][t1_id+1]        # this record doesn't exist
     assert db['t1'](t1_id=t1_id)['f'] == 2
+    # identity map: the same record object is returned (no extra query)
+    r1 = db['t1'][t1_id]
+    assert r1['f'] == 2
+    assert db['t1'][t1_id] is r1 and db['t1'](t1_id=t1_id) is r1
+    # compact record (slotted) for the known schema:
+    r0 = db['t1'][id1]
+    assert isinstance(r0, Record) and not hasattr(r0, "__dict__")
+    assert sorted(r0.keys()) == ['f', 's', 't1_id'] and r0['s'] == "PI"
+    assert r0.get("unknown", 0) == 0 and dict(r0)['s'] == "PI"
+    assert dict(db['t1'](s="PI"))['t1_id'] == id1
+    assert [r for r in db['t1'].select(t1_id=t1_id)][0] is r1
+    db.update("t1", t1_id=t1_id, f=2.5)
+    assert r1['f'] == 2.5
+    db.delete("t1", t1_id=t1_id + 1)
+    assert not db['t1'][t1_id + 1]
+    del r1
     r['f'] = 99
     r = db['t1'](f=99)
     print r['t1_id']
@@ -393,6 +1381,150 @@ if __name__ == "__main__":
     assert s['chau']['t1_id'] == id1
     assert s['nana']['n'] == 4
     s.close()
+    # test lazy shelve (rows are fetched on demand) and deletion:
+    s = Shelf(db, "t2", "s", t1_id=id1)
+    assert len(s) == 3 and not s.dict
+    s['chau']['n'] = 5
+    assert s.dirty == set(['chau'])
+    s.sync()
+    del s['nana']
+    s['new'] = {'n': 6}
+    s.sync()
+    del s['new']
+    s.close()
+    s = Shelf(db, "t2", "s", t1_id=id1)
+    assert sorted(s.keys()) == ['chau', 'hola']
+    assert sorted([r['n'] for r in s.values()]) == [3, 5]
+    # reassign a key inserted in this session (update it, do not duplicate):
+    s['again'] = {'n': 1}
+    s.sync()
+    s['again'] = {'n': 2}
+    s.sync()
+    s['again'] = {'n': 3}
+    s.sync()
+    assert [r['n'] for r in db.select("t2", s="again", t1_id=id1)] == [3]
+    assert not db.select("t2", t1_id=None)
+    del s['again']
+    s.close()
+    del s
+    # test write-behind (batched inserts and merged updates):
+    for i in range(10):
+        db['t2'].new(n=i, s="batch", t1_id=id1).save(defer=True)
+    assert len(db.local.new_rows['t2']) == 10
+    db.commit()
+    assert not db.local.new_rows
+    rows = db.select('t2', s="batch")
+    assert len(rows) == 10
+    for i, r in enumerate(db['t2'].select(s="batch")):
+        r['f'] = i
+        r['n'] = i * 2 if i % 2 else None
+        r.save(defer=True)
+        r['f'] = i + 0.5
+        r.save(defer=True)
+    assert len(db.local.dirty_rows['t2']) == 10
+    assert db.flush() == 10
+    for r in db['t2'].select(s="batch"):
+        assert r['f'] % 1 == 0.5        # last update won
+    db.commit()
+    # test the background writer (coalescing updates to the same row):
+    db.writer = Writer(db, interval=60)
+    db.writer.start()
+    r = db['t1'][id1]
+    for i in range(100):
+        r['f'] = i
+        r.save(defer=True)
+        db.commit()
+    assert db.writer.pending()
+    db.barrier()
+    assert not db.writer.pending()
+    assert db.select('t1', t1_id=id1)[0]['f'] == 99
+    db.insert("t2", n=7, s="writer")
+    assert db.delete("t2", s="writer") == 1
+    # the transactions are written by its thread (they can be rolled back):
+    try:
+        with db.transaction():
+            db.insert("t2", n=8, s="rollback")
+            db.delete("t2", s="batch")
+            db.commit()     # committed at the end of the block (not here)
+            raise RuntimeError("abort")
+    except RuntimeError:
+        pass
+    assert not db.select("t2", s="rollback")
+    assert len(db.select("t2", s="batch")) == 10
+    # an invalid row does not discard the others (its owner gets the error):
+    dup_id = db.insert("t2", n=9, s="duplicated")
+    db.insert("t2", _defer=True, t2_id=dup_id, s="duplicated")
+    db.insert("t2", _defer=True, n=9, s="valid")
+    try:
+        db.barrier()
+    except sqlite3.IntegrityError:
+        pass
+    else:
+        raise AssertionError("duplicated row not reported")
+    assert db.delete("t2", n=9) == 2
+    db.shutdown()
+    assert db.writer is None
+    # test streaming queries (ordering, limits, operators and joins):
+    rows = list(db.query('t2', s="batch", _order=["-n", "t2_id"], _limit=3,
+                         _offset=1, _size=2))
+    assert [r['n'] for r in rows] == [14, 10, 6]
+    rows = list(db.query('t2', n__in=[2, 6, 18], f__lt=6))
+    assert [r['n'] for r in rows] == [2, 6]
+    assert len(list(db.query('t2', s="batch", n=None))) == 5
+    assert len(list(db.query('t2', s="batch", n__ne=None, n__ge=10))) == 3
+    rows = db['t2'].query(_join="t1", _where={"t1.s": "PI"}, s__like="b%")
+    assert len(set([r['t2_id'] for r in rows])) == 10
+    # test instrumentation (statistics and query plans):
+    db.profiler = Profiler(slow=0)
+    for i in range(3):
+        db.select("t2", s="batch")
+    count = len(list(db.query("t2", n__gt=10)))
+    stats = db.profiler.statements["SELECT * FROM t2 WHERE s=?"]
+    assert stats[0] == 3 and stats[3] == 30
+    assert db.profiler.statements["SELECT * FROM t2 WHERE t2.n > ?"][3] == count
+    assert db.profiler.callers[("<MainThread>", 0, "")][0] == 4
+    assert "t2_s_n_ix" in db.profiler.plans["SELECT * FROM t2 WHERE s=?"][0]
+    print db.profiler.report()
+    db.profiler = None
+    # test full-text search (kept updated by triggers):
+    db.create("t3", t3_id=int, title=str, description=str, t1_id=int)
+    db.insert("t3", title="fix the debugger", description="pipe is slow", 
+              t1_id=id1)
+    db.create_search("t3", "title", "description")
+    db.insert("t3", title="slow database", description="add indexes",
+              t1_id=id1)
+    db.insert("t3", title="other", description="nothing to see", t1_id=id1)
+    rows = db.search("t3", "slow")
+    assert [r['title'] for r in rows] == ["slow database", "fix the debugger"]
+    assert "[slow]" in rows[0]['snippet']
+    assert len(db.search("t3", "index", t1_id=id1)) == 1
+    db.update("t3", t3_id=rows[0]['t3_id'], title="fast database")
+    db.delete("t3", title="other")
+    assert len(db.search("t3", "slow")) == 1 and not db.search("t3", "see")
+    db.create_search("t3", "title", "description")      # already created
+    # test concurrent access (a connection per thread):
+    def worker(n):
+        with db.transaction():
+            for i in range(50):
+                db.insert("t2", n=n, s="thread")
+    threads = [threading.Thread(target=worker, args=(n, )) for n in range(4)]
+    for th in threads:
+        th.start()
+    rows = db.select('t2', s="thread")              # don't block on readers
+    for th in threads:
+        th.join()
+    assert db.select('t2', s="thread", n=len)[0][0] == 200
+    # in-memory databases are shared by the threads (a single connection):
+    mem = Database(":memory:")
+    mem.create("t4", t4_id=int, n=int)
+    th = threading.Thread(target=mem.insert, args=("t4", ), kwargs={'n': 1})
+    th.start()
+    th.join()
+    assert mem.select("t4", n=1)
+    db.shutdown()
+    db.close()
+    import shutil
+    shutil.rmtree(os.path.dirname(path))
     print "Closed!"
     
 
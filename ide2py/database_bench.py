@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"Benchmarks for the database layer (simulated IDE workloads)"
+
+__author__ = "Mariano Reingart (reingart@gmail.com)"
+__copyright__ = "Copyright (C) 2014 Mariano Reingart"
+__license__ = "GPL 3.0"
+
+# Usage: python database_bench.py [scale] [write_interval] [benchmark ...]
+#   scale: multiply the default number of operations (i.e. 0.1 for a quick run)
+#   write_interval: seconds to coalesce writes in background (default: None)
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from database import Database, Shelf
+from schema import create_task_tables, create_psp_tables
+
+
+PSP_PHASES = ["planning", "design", "code", "compile", "test", "postmortem"]
+DAY_TICKS = 8 * 60 * 60     # one tick per second (a working day)
+
+
+def create_schema(db):
+    "Create the tables used by the IDE (the same as task.py and psp.py)"
+    create_task_tables(db)
+    create_psp_tables(db)
+    task_id = db.insert("task", task_name="bench", task_uuid="bench")
+    db.commit()
+    return task_id
+
+
+def bench_psp_ticks(db, task_id, scale=1.0):
+    "Count the time of a working day (PSPTimeTable.count, synced every tick)"
+    data = Shelf(db, "time_summary", "phase", task_id=task_id)
+    for phase in PSP_PHASES:
+        data[phase] = {'plan': 60.0, 'actual': 0, 'interruption': 0,
+                       'off_task': 0}
+    data.sync()
+    ticks = int(DAY_TICKS * scale)
+    for i in xrange(ticks):
+        phase = PSP_PHASES[i * len(PSP_PHASES) // ticks]
+        if i % 60 == 59:
+            key_time = "interruption"
+        else:
+            key_time = "actual"
+        row = data[phase]
+        row[key_time] = (row.get(key_time) or 0) + 1
+        data.sync()
+    data.close()
+    total = sum([db.select("time_summary", task_id=task_id, phase=phase)[0]
+                 ['actual'] for phase in PSP_PHASES])
+    assert total == ticks - ticks // 60, total
+    return ticks
+
+
+def bench_defects(db, task_id, scale=1.0):
+    "Add, reload, fix and remove defects (PSPDefectList)"
+    count = int(5000 * scale)
+    data = Shelf(db, "defect", "uuid", task_id=task_id)
+    for i in xrange(count):
+        key = "uuid-%d" % i
+        data[key] = {'number': i + 1, 'summary': "defect %d" % i,
+                     'description': "invalid syntax", 'date': "2014-01-01",
+                     'type': 20, 'inject_phase': "code", 'remove_phase': None,
+                     'fix_time': 0.0, 'fix_defect': None, 'checked': False,
+                     'filename': "module%d.py" % (i % 50), 'lineno': i,
+                     'offset': i % 80}
+        data.sync()
+    data.close()
+    # reopen the list (the rows are loaded in a single query)
+    data = Shelf(db, "defect", "uuid", task_id=task_id)
+    numbers = [int(defect['number'] or 0) for defect in data.values()]
+    assert max(numbers) == count
+    # fix half of them (checking the duplicate), remove a tenth
+    for i in xrange(0, count, 2):
+        defect = data["uuid-%d" % i]
+        defect['fix_time'] = (defect['fix_time'] or 0) + 30
+        defect['remove_phase'] = "compile"
+        defect['checked'] = True
+    data.sync()
+    for i in xrange(0, count, 10):
+        del data["uuid-%d" % i]
+    data.close()
+    db.commit()
+    assert len(Shelf(db, "defect", "uuid", task_id=task_id)) == count - \
+                                                       len(range(0, count, 10))
+    return count * 3 + count // 2 + count // 10
+
+
+def bench_context(db, task_id, scale=1.0):
+    "Save and restore editor context files (TaskMixin, many bps and folds)"
+    files = int(50 * scale) or 1
+    rounds = 5
+    ops = 0
+    for n in xrange(rounds):
+        # save the context of each file (replacing previous bps and folds):
+        for i in xrange(files):
+            filename = "module%d.py" % i
+            with db.transaction():
+                ctx = db["context_file"](task_id=task_id, filename=filename)
+                if not ctx:
+                    ctx = db["context_file"].new(task_id=task_id,
+                                                 filename=filename)
+                ctx['lineno'] = n * 10 + i
+                ctx['total_time'] = (ctx.get('total_time') or 0) + 60
+                ctx['closed'] = False
+                ctx.save()
+                ctx_id = ctx['context_file_id']
+                db["breakpoint"].delete(context_file_id=ctx_id)
+                for lineno in xrange(100):
+                    bp = db["breakpoint"].new(lineno=lineno * 7 + n,
+                                              temp=False, cond=None)
+                    bp['context_file_id'] = ctx_id
+                    bp.save(defer=True)
+                db["fold"].delete(context_file_id=ctx_id)
+                for lineno in xrange(200):
+                    fold = db["fold"].new(level=lineno % 4,
+                                          start_lineno=lineno,
+                                          end_lineno=lineno + 3,
+                                          expanded=bool(lineno % 2))
+                    fold['context_file_id'] = ctx_id
+                    fold.save(defer=True)
+            ops += 1 + 100 + 200
+        # restore the context of each file:
+        for ctx in db["context_file"].query(task_id=task_id,
+                                            _order="-total_time"):
+            q = dict(context_file_id=ctx['context_file_id'])
+            bps = [bp for bp in db["breakpoint"].select(**q)]
+            folds = [fold for fold in db["fold"].select(**q)
+                     if fold['expanded']]
+            assert len(bps) == 100 and len(folds) == 100
+            ops += 1 + 100 + 200
+    return ops
+
+
+def bench_task_sync(db, task_id, scale=1.0):
+    "Insert and then update the tasks from a repository (TaskMixin.sync)"
+    count = int(1000 * scale)
+    ops = 0
+    for status in ("open", "closed"):
+        with db.transaction():
+            for i in xrange(count):
+                data = {'name': "issue-%d" % i,
+                        'description': "issue %d" % i, 'type': "bug",
+                        'resolution': "", 'started': "2014-01-01",
+                        'owner': "reingart", 'status': status}
+                task = db["task"](task_name=data['name'],
+                                  organization="reingart", project="rad2py",
+                                  connector="github")
+                if not task:
+                    task = db["task"].new(task_name=data['name'],
+                                          task_uuid="uuid-%d" % i,
+                                          connector="github",
+                                          organization="reingart",
+                                          project="rad2py")
+                    task.save()
+                for k, v in data.items():
+                    if k in task.keys():
+                        task[k] = v
+                task['closed'] = data['status'] == 'closed'
+                task.save(defer=True)
+                ops += 1
+    assert len(db.select("task", closed=True)) == count
+    return ops
+
+
+BENCHMARKS = [
+    ("psp_ticks", bench_psp_ticks),
+    ("defects", bench_defects),
+    ("context", bench_context),
+    ("task_sync", bench_task_sync),
+    ]
+
+
+def run(name, function, scale=1.0, write_interval=None):
+    "Execute a benchmark in a new temporary database, return its stats"
+    path = tempfile.mkdtemp(prefix="rad2py-bench-")
+    try:
+        db = Database(os.path.join(path, "bench.db"),
+                      write_interval=write_interval, profile=True,
+                      slow_query=3600)
+        task_id = create_schema(db)
+        db.profiler.reset()
+        t0 = time.time()
+        ops = function(db, task_id, scale)
+        db.commit()
+        if db.writer:
+            db.barrier()
+        elapsed = time.time() - t0
+        statements = sum([stats[0] for stats in
+                          db.profiler.statements.values()])
+        db.shutdown()
+        db.close()
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+    return ops, elapsed, statements
+
+
+def main(argv):
+    scale = float(argv[1]) if len(argv) > 1 else 1.0
+    write_interval = float(argv[2]) if len(argv) > 2 and argv[2] else None
+    names = argv[3:] or [name for name, function in BENCHMARKS]
+    print "%-12s %10s %10s %12s %12s %10s" % ("benchmark", "ops", "seconds",
+                                          "ops/sec", "statements", "stmt/op")
+    for name, function in BENCHMARKS:
+        if name not in names:
+            continue
+        ops, elapsed, statements = run(name, function, scale, write_interval)
+        print "%-12s %10d %10.3f %12.1f %12d %10.3f" % (name, ops, elapsed,
+                ops / max(elapsed, 1e-6), statements, statements / float(ops))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
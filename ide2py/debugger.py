@@ -12,7 +12,11 @@ __license__ = "GPL 3.0"
 from multiprocessing.connection import Listener
 import compiler
 import os
+import select
 import sys
+import threading
+import time
+import Queue
 import wx
 import wx.gizmos
 from wx.lib.mixins.listctrl import ListCtrlAutoWidthMixin
@@ -21,6 +25,8 @@ import qdb
 
 # Define notification event for thread completion
 EVT_DEBUG_ID, EVT_EXCEPTION_ID = [wx.NewId() for i in range(2)]
+# location context to clean up the call stack and environment panes
+EMPTY_CONTEXT = {'call_stack': [], 'environment': {}}
 
 
 class DebugEvent(wx.PyEvent):
@@ -31,47 +37,122 @@ class DebugEvent(wx.PyEvent):
         self.data = data
 
 
-class LoggingPipeWrapper(object):
-    
-    def __init__(self, pipe):
-        self.__pipe = pipe
-    
-    def send(self, data):
-        print("PIPE:send: %s %s %s %s" % (data.get("id"), data.get("method"), data.get("args"), repr(data.get("result",""))[:40]))
-        self.__pipe.send(data)
-
-    def recv(self, *args, **kwargs):
-        data = self.__pipe.recv(*args, **kwargs)
-        print("PIPE:recv: %s %s %s %s" % (data.get("id"), data.get("method"), data.get("args"), repr(data.get("result",""))[:40]))
-        return data
-    
-    def close(self):
-        self.__pipe.close()
-    
-    def poll(self):
-        return self.__pipe.poll()
+class LoggingPipeWrapper(qdb.CapturePipe):
+    "Print every message and optionally capture the session (for replay)"
 
-        
-class Debugger(qdb.Frontend):
-    "Frontend Visual interface to qdb"
+    def __init__(self, pipe, capture=None, verbose=True):
+        qdb.CapturePipe.__init__(self, pipe, capture)
+        self.verbose = verbose
 
-    def __init__(self, gui=None, pipe=None, host='localhost', port=6000, authkey='secret password'):
-        qdb.Frontend.__init__(self, pipe)
+    def record(self, direction, data):
+        if self.verbose:
+            print("PIPE:%s: %s %s %s %s" % (direction, data.get("id"),
+                data.get("method"), data.get("args"),
+                repr(data.get("result",""))[:40]))
+        qdb.CapturePipe.record(self, direction, data)
+
+
+def is_alive(pid):
+    "Check that a process is still running (POSIX, assume it elsewhere)"
+    if os.name != "posix":
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+class Session(object):
+    "State of a debugged process (one per attached backend)"
+
+    def __init__(self, name="", local=False):
+        self.name = name
+        self.local = local          # child process launched by the IDE
+        self.pid = None             # of the child process (if local)
+        self.address = None         # listener that accepted the backend
+        self.pipe = None
+        self.reading = False        # pipe is being read by the reader thread
         self.interacting = False    # flag to signal user interaction
         self.quitting = False       # flag used when Quit is called
         self.attached = False       # flag to signal remote side availability
-        self.gui = gui              # wx window for callbacks
         self.post_event = True      # send event to the GUI
         self.start_continue = True  # continue on first run
         self.rawinput = None
-        self.filename = self.lineno = None
+        self.filename = self.lineno = self.orig_line = None
         self.unrecoverable_error = False
-        self.pipe = None
-        address = (host, port)     # family is deduced to be 'AF_INET'
+        self.futures = {}           # pending remote calls (by request id)
+        self.breakpoints = {}       # {(filename, lineno): (temporary, cond)}
+        self.location = None        # last interaction (to show it again)
+        self.output = []            # console text written while not selected
+
+
+def session_attribute(name):
+    "Property to access the state of the current session"
+    return property(lambda self: getattr(self.session, name),
+                    lambda self, value: setattr(self.session, name, value))
+
+
+class Debugger(qdb.Frontend):
+    "Frontend Visual interface to qdb"
+
+    # state of the session being processed (see Session):
+    pipe = session_attribute("pipe")
+    interacting = session_attribute("interacting")
+    quitting = session_attribute("quitting")
+    attached = session_attribute("attached")
+    post_event = session_attribute("post_event")
+    start_continue = session_attribute("start_continue")
+    rawinput = session_attribute("rawinput")
+    filename = session_attribute("filename")
+    lineno = session_attribute("lineno")
+    orig_line = session_attribute("orig_line")
+    unrecoverable_error = session_attribute("unrecoverable_error")
+    futures = session_attribute("futures")
+
+    def __init__(self, gui=None, pipe=None, host='localhost', port=6000,
+                 authkey='secret password', capture=None, eval_timeout=None,
+                 exception_policy=None, shared_memory=False, 
+                 attach_timeout=None, max_refresh=10):
+        # current session (messages are processed in its context) and the 
+        # one selected in the GUI (to interact with the user): 
+        self.session = self.selected = Session()
+        self.sessions = []          # attached sessions
+        self.session_count = 0
+        qdb.Frontend.__init__(self, pipe)
+        self.gui = gui              # wx window for callbacks
+        self.capture = capture      # filename to record the session (replay)
+        self.eval_timeout = eval_timeout    # time budget for expressions
+        self.exception_policy = exception_policy  # rules to stop on exc.
+        self.busy_interval = 0.5    # show progress if a call takes longer
+        self.busy_dialog = None
+        self.shared_memory = shared_memory  # local sessions without sockets
+        self.shm_pipe = None
+        self.attach_timeout = attach_timeout    # seconds to wait the child
+        self.attaching = None       # session waiting the backend connection
+        self.attach_dialog = None
+        self.listeners = {}         # {address: (listener, authkey)}
+        self.acceptors = {}         # threads to accept backend connections
+        self.connections = []       # accepted while no session was waiting
+        self.max_refresh = max_refresh  # GUI updates per second (stepping)
+        self.gui_location = None    # latest location to show in the GUI
+        self.location_timer = None
+        self.last_refresh = 0
+        self.inbox = Queue.Queue()  # (session, message) read by the thread
+        self.pending = []           # message already taken out by poll
+        self.reader = None          # thread to read all the pipes
+        self.wakeup = threading.Event()
+        if os.name == "posix":
+            # self-pipe to wake up the reader when a session is added
+            self.wakeup_pipe = os.pipe()
+        else:
+            self.wakeup_pipe = None     # no select on pipes (windows)
+        self.idle_timeout = 0.25    # block on a pipe (if not selectable)
+        # default address (local child processes connect to it):
         self.address = (host, port)
         self.authkey = authkey
         try:
-            self.listener = Listener(address, authkey=authkey)
+            self.listen(host, port, authkey)
         except IOError as e:
             dlg = wx.MessageDialog(self.gui, 
                    "Exception raised: %s\n\n"
@@ -82,21 +163,131 @@ class Debugger(qdb.Frontend):
             dlg.ShowModal() 
             dlg.Destroy()
             wx.GetApp().Exit()
-        wx.GetApp().Bind(wx.EVT_IDLE, self.OnIdle) # schedule debugger execution
 
+    def add_session(self, session):
+        "Start reading the pipe of a new session (in the reader thread)"
+        self.sessions.append(session)
+        session.reading = True
+        if not self.reader:
+            self.reader = threading.Thread(target=self.read_pipes)
+            self.reader.daemon = True
+            self.reader.start()
+        self.wakeup.set()
+        if self.wakeup_pipe:
+            os.write(self.wakeup_pipe[1], "!")
 
-    def OnIdle(self, event):
-        "Debugger main loop: read and execute remote methods"
+    def read_pipes(self):
+        "Reader thread: receive messages of all sessions and wake up the GUI"
+        while True:
+            sessions = [session for session in self.sessions 
+                        if session.reading]
+            if not sessions:
+                # nothing to read, sleep until a session is added 
+                self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+            ready = self.wait_pipes(sessions)
+            for session in ready:
+                try:
+                    while session.reading and session.pipe.poll():
+                        self.inbox.put((session, session.pipe.recv()))
+                except Exception, e:
+                    # pass the error to the main thread (i.e. EOFError)
+                    session.reading = False
+                    self.inbox.put((session, e))
+            if ready:
+                wx.CallAfter(self.OnDebugMessage)
+
+    def wait_pipes(self, sessions):
+        "Block until some sessions have data available (return them)"
+        ready = []
+        fds = {}
+        for session in sessions:
+            try:
+                if self.wakeup_pipe:
+                    # socket, or doorbell of the shared memory (see fileno)
+                    fds[session.pipe.fileno()] = session
+            except Exception:
+                pass    # not selectable (replay) or closed
+            # check the data already received (after preparing the doorbell)
+            try:
+                if session.pipe.poll():
+                    ready.append(session)
+            except Exception:
+                ready.append(session)   # recv will raise the error
+        if ready:
+            timeout = 0
+        elif len(fds) < len(sessions):
+            # some pipes must be polled, do not sleep too much
+            timeout = 0.01
+        elif [session for session in sessions if session.local]:
+            # the child could die silently (shared memory), poll it again
+            timeout = 1
+        else:
+            timeout = None
+        if not self.wakeup_pipe:
+            if not ready:
+                # nothing to select on (windows): block on the pipe of the
+                # selected session (the others are checked on timeout)
+                if self.selected in sessions:
+                    session = self.selected
+                else:
+                    session = sessions[0]
+                try:
+                    if session.pipe.poll(self.idle_timeout):
+                        ready.append(session)
+                except Exception:
+                    ready.append(session)   # recv will raise the error
+            return ready
+        wakeup = self.wakeup_pipe[0]
         try:
-            if self.attached and self.pipe:
-                while self.pipe.poll():
-                    self.run()
-        except EOFError:
-            print "DEBUGGER disconnected..."
-            self.detach()
-        except IOError, e:
-            print "DEBUGGER connection exception:", e
-            self.detach()
+            readable = select.select(fds.keys() + [wakeup], [], [], 
+                                     timeout)[0]
+        except (select.error, ValueError):
+            return ready    # pipe closed meanwhile, try again
+        if wakeup in readable:
+            os.read(wakeup, 4096)
+        return ready + [fds[fd] for fd in readable if fd in fds]
+
+    def recv(self):
+        "Return the next (session, message) read by the thread (blocking)"
+        if self.pending:
+            return self.pending.pop(0)
+        else:
+            return self.inbox.get()
+
+    def process_message(self, item):
+        "Process a message in the context of its session"
+        session, msg = item
+        previous = self.session
+        self.session = session
+        try:
+            if not session.attached:
+                pass    # ignore remaining messages of a closed session
+            elif isinstance(msg, Exception):
+                self.disconnect(msg)
+            else:
+                return qdb.Frontend.process_message(self, msg)
+        finally:
+            # restore the context (nested messages could be processed while
+            # waiting the response of a remote call of other session)
+            self.session = previous
+
+    def poll(self, timeout=0.0):
+        "Check if the background thread has read a message (up to timeout)"
+        if not self.pending:
+            try:
+                block = timeout is None or timeout > 0
+                self.pending.append(self.inbox.get(block, timeout))
+            except Queue.Empty:
+                return False
+        return True
+
+    def OnDebugMessage(self, event=None):
+        "Debugger main loop: execute remote methods (read by the thread)"
+        try:
+            while self.poll():
+                self.process_message(self.recv())
         except Exception, e:
             # show the exception message and abort (avoid recursion)
             # known causes: pickle (ImportError)
@@ -109,9 +300,24 @@ class Debugger(qdb.Frontend):
             dlg.ShowModal()
             dlg.Destroy()
             self.detach()
+        finally:
+            # go back to the session selected by the user
+            self.session = self.selected
 
-    def init(self, cont=False):
-        # restore sane defaults:
+    def disconnect(self, error):
+        "Handle a closed connection (the session is detached)"
+        if isinstance(error, EOFError):
+            print "DEBUGGER disconnected...", self.session.name
+        else:
+            print "DEBUGGER connection exception:", self.session.name, error
+        self.detach()
+
+    def init(self, cont=False, select=True):
+        "Start a new session (restoring sane defaults)"
+        # select: interact with it now (else, when other sessions end)
+        self.session = Session()
+        if select:
+            self.selected = self.session
         self.start_continue = cont
         self.unrecoverable_error = None
         self.attached = True
@@ -119,23 +325,237 @@ class Debugger(qdb.Frontend):
         self.post_event = True
         self.lineno = None
         
-    def attach(self):
-        print "DEBUGGER waiting for connection to", self.address
-        conn = self.listener.accept()
-        self.pipe = LoggingPipeWrapper(conn)
-        print "DEBUGGER connected!"
-    
+    def prepare(self):
+        "Set up the transport for a local child process (return its env.)"
+        if not self.shared_memory or not hasattr(qdb, "SharedMemoryPipe"):
+            return {}
+        if self.shm_pipe:
+            self.shm_pipe.close()
+        self.shm_pipe = qdb.SharedMemoryPipe.create()
+        return {'QDB_SHM': self.shm_pipe.filename}
+
+    def attach(self, host=None, port=None, authkey=None, local=None, 
+               pid=None):
+        "Wait for a backend connection (local: child process of the IDE)"
+        # host, port, authkey: address to accept the remote backend
+        # pid: child process (to not wait it if it terminates)
+        if local is None:
+            local = host is None
+        address = self.address
+        if host is not None:
+            try:
+                address = self.listen(host, port or self.address[1], 
+                                      authkey or self.authkey)
+            except IOError, e:
+                self.gui.ShowInfoBar("debugger not attached: %s" % e,
+                                     flags=wx.ICON_INFORMATION, key="debugger")
+                return
+        if self.session in self.sessions:
+            # already connected, do not replace the current session
+            self.init()
+        session = self.session
+        session.local = local
+        session.pid = pid
+        session.address = address
+        # go back to the session selected by the user (if it was not this)
+        self.session = self.selected
+        if self.shm_pipe and local:
+            # local child process: use the shared memory prepared before
+            print "DEBUGGER using shared memory", self.shm_pipe.filename
+            conn, self.shm_pipe = self.shm_pipe, None
+            conn.peer_pid = pid
+            self.start_session(session, LoggingPipeWrapper(conn, self.capture),
+                               "local")
+            return
+        if self.attaching:
+            self.abort_attach("superseded by a new session", kill=False)
+        for i, (conn, remote, accepted_by) in enumerate(self.connections):
+            if accepted_by == address:
+                # the backend connected before (i.e. remote)
+                del self.connections[i]
+                self.start_session(session, 
+                                   LoggingPipeWrapper(conn, self.capture),
+                                   "local" if local else "%s:%s" % remote)
+                return
+        # do not block the GUI, the connection is accepted by a thread:
+        print "DEBUGGER waiting for connection to", address
+        self.attaching = session
+        self.attach_started = time.time()
+        if address not in self.acceptors:
+            listener = self.listeners[address][0]
+            acceptor = threading.Thread(target=self.accept_connections,
+                                        args=(address, listener))
+            acceptor.daemon = True
+            acceptor.start()
+            self.acceptors[address] = acceptor
+        self.attach_dialog = wx.ProgressDialog("Debugger", 
+                "Waiting for the debugged process to connect...", 
+                parent=self.gui, style=wx.PD_CAN_ABORT | wx.PD_ELAPSED_TIME)
+        wx.CallLater(100, self.check_attach, session)
+
+    def listen(self, host, port, authkey):
+        "Accept the backend connections at an address (return it)"
+        # the other listeners are kept (i.e. local child processes)
+        address = (host, port)
+        if address in self.listeners:
+            listener, listener_authkey = self.listeners[address]
+            if authkey == listener_authkey:
+                return address
+            # the acceptor thread (if any) ends when its listener closes
+            del self.listeners[address]
+            self.acceptors.pop(address, None)
+            listener.close()
+        listener = Listener(address, authkey=authkey)
+        self.listeners[address] = (listener, authkey)
+        return address
+
+    def accept_connections(self, address, listener):
+        "Acceptor thread: wait backend connections (see attach)"
+        while self.listeners.get(address, (None, ))[0] is listener:
+            try:
+                conn = listener.accept()
+            except Exception, e:
+                # failed handshake (i.e. wrong authkey), wait another one
+                print "DEBUGGER connection rejected:", e
+                continue
+            wx.CallAfter(self.connected, conn, listener.last_accepted,
+                         address)
+
+    def connected(self, conn, address, accepted_by=None):
+        "Start the session that was waiting the backend (if any)"
+        session = self.attaching
+        if not session or session.address != accepted_by:
+            # keep the connection for the next attach (at that address)
+            self.connections.append((conn, address, accepted_by))
+            return
+        self.end_attach()
+        self.start_session(session, LoggingPipeWrapper(conn, self.capture),
+                           "local" if session.local else "%s:%s" % address)
+
+    def check_attach(self, session):
+        "Update the progress of the attach (checking timeout and cancel)"
+        if self.attaching is not session:
+            return      # already connected or aborted
+        elapsed = time.time() - self.attach_started
+        if not self.attach_dialog.Pulse()[0]:
+            self.abort_attach("cancelled by the user")
+        elif session.local and self.attach_timeout and \
+                elapsed > self.attach_timeout:
+            self.abort_attach("timeout (%s s)" % self.attach_timeout)
+        elif session.pid and not is_alive(session.pid):
+            self.abort_attach("process terminated", kill=False)
+        else:
+            wx.CallLater(100, self.check_attach, session)
+
+    def end_attach(self):
+        self.attaching = None
+        if self.attach_dialog:
+            self.attach_dialog.Destroy()
+            self.attach_dialog = None
+
+    def abort_attach(self, reason, kill=True):
+        "Stop waiting the backend (it is killed if it is a child process)"
+        session = self.attaching
+        self.end_attach()
+        session.attached = False
+        print "DEBUGGER not attached:", reason
+        self.gui.ShowInfoBar("debugger not attached: %s" % reason,
+                             flags=wx.ICON_INFORMATION, key="debugger")
+        if session.local and kill:
+            self.gui.OnKill(None)
+
+    def release(self):
+        "Remove the transport prepared for a child that was not attached"
+        if self.shm_pipe:
+            self.shm_pipe.close()
+            self.shm_pipe = None
+
+    def AbortAttach(self, reason):
+        "Notify that the child process terminated (do not wait it anymore)"
+        if self.attaching and self.attaching.local:
+            self.abort_attach(reason)
+
+    def replay(self, filename, speed=None):
+        "Feed a captured session (full speed or original timing if speed=1)"
+        self.init()
+        self.start_session(self.session, qdb.ReplayPipe(filename, speed),
+                           "replay %s" % os.path.basename(filename))
+
+    def start_session(self, session, pipe, name):
+        "Register a session (and read its pipe)"
+        self.session_count += 1
+        session.name = "#%s %s" % (self.session_count, name)
+        session.pipe = pipe
+        if self.selected not in self.sessions:
+            # no other session to interact with, select this one
+            self.selected = session
+        self.add_session(session)
+        print "DEBUGGER connected!", session.name
+
     def detach(self):
+        session = self.session
+        session.reading = False
         self.attached = False
         if self.pipe:
             self.pipe.close()
+        # abort the remote calls that are still waiting a response:
+        for future in self.futures.values():
+            future.set_response({'id': None, 'result': None, 'error': 
+                                 {'code': 0, 'message': "Session detached"}})
+        self.futures.clear()
         self.clear_interaction()
-        # just in case, send a KILL signal to child process
-        self.gui.OnKill(None)
+        if session is self.selected:
+            # the session ended, clean up the call stack and variables panes
+            self.post_location((None, None, EMPTY_CONTEXT, None))
+        if session in self.sessions:
+            self.sessions.remove(session)
+        if session.local:
+            # just in case, send a KILL signal to child process
+            self.gui.OnKill(None)
+        if session is self.selected and self.sessions:
+            # switch to another session that is still running
+            self.SelectSession(self.sessions[-1])
+
+    def SelectSession(self, session):
+        "Interact with other session (console output, current line, etc.)"
+        switched = session is not self.selected
+        self.session = self.selected = session
+        if session.output:
+            # show the output written while this session was not selected
+            self.gui.Write("".join(session.output))
+            session.output = []
+        if self.gui:
+            location = session.interacting and session.location
+            if not location and switched:
+                # do not show the panes of the previous session
+                location = (None, None, EMPTY_CONTEXT, None)
+            self.post_location(location or (None, None, None, None))
+
+    def post_location(self, location):
+        "Show the current line in the GUI (at most max_refresh per second)"
+        # only the latest location is rendered (intermediate are skipped)
+        self.gui_location = location
+        if self.location_timer:
+            return      # already scheduled
+        if not self.max_refresh or self.max_refresh <= 0:
+            wait = 0    # no limit: refresh on every location
+        else:
+            wait = self.last_refresh + 1. / self.max_refresh - time.time()
+        if wait <= 0:
+            self.flush_location()
+        else:
+            self.location_timer = wx.CallLater(int(wait * 1000) + 1, 
+                                               self.flush_location)
+
+    def flush_location(self):
+        self.location_timer = None
+        self.last_refresh = time.time()
+        wx.PostEvent(self.gui, DebugEvent(EVT_DEBUG_ID, self.gui_location))
 
     def is_remote(self):
+        address = self.session.address or self.address
         return (self.attached and 
-                self.address[0] not in ("localhost"))
+                address[0] not in ("localhost"))
 
     def check_interaction(fn):
         "Decorator for mutually exclusive functions"
@@ -182,7 +602,7 @@ class Debugger(qdb.Frontend):
             while not self.interacting and i:
                 # allow wx process some events 
                 wx.SafeYield()      # safe = user input "disabled"
-                self.OnIdle(None)   # force pipe processing
+                self.OnDebugMessage()   # force pipe processing
                 i -= 1              # decrement safety counter
             if self.interacting:
                 # send the method request                
@@ -210,8 +630,8 @@ class Debugger(qdb.Frontend):
     def clear_interaction(self): 
         self.interacting = False
         # interaction is done, clean current line marker
-        wx.PostEvent(self.gui, DebugEvent(EVT_DEBUG_ID, 
-                                         (None, None, None, None)))
+        if self.session is self.selected:
+            self.post_location((None, None, None, None))
         
     def startup(self):
         "Initialization procedures (called by the backend)"
@@ -219,7 +639,10 @@ class Debugger(qdb.Frontend):
         print "loading breakpoints...."
         self.LoadBreakpoints()
         print "enabling call_stack and environment at interaction"
-        self.set_params(dict(call_stack=True, environment=True, postmortem=True))
+        self.set_params(dict(call_stack=True, environment=True, postmortem=True,
+                             eval_timeout=self.eval_timeout))
+        if self.exception_policy:
+            self.set_exception_policy(self.exception_policy)
         # return control to the backend:
         qdb.Frontend.startup(self)
 
@@ -238,22 +661,66 @@ class Debugger(qdb.Frontend):
                 self.filename = filename
                 self.orig_line = line.strip().strip("\r").strip("\n")
                 self.lineno = lineno
+                if context.get('watch'):
+                    # stopped by a watchpoint, show the expression change
+                    self.gui.ShowInfoBar("watch %s: %s -> %s" % 
+                                         context['watch'], 
+                                         flags=wx.ICON_INFORMATION, 
+                                         key="debugger")
+                self.session.location = (filename, lineno, context, line)
                 if self.gui and self.post_event:
-                    # send the event to mark the current line
-                    wx.PostEvent(self.gui, DebugEvent(EVT_DEBUG_ID, 
-                                                      (filename, lineno, context, line)))
+                    if self.session is self.selected or \
+                            not self.selected.interacting:
+                        # send the event to mark the current line
+                        self.SelectSession(self.session)
+                    else:
+                        # do not disturb the user (using other session)
+                        self.gui.ShowInfoBar("%s stopped at %s:%s" % (
+                                    self.session.name, 
+                                    os.path.basename(filename), lineno),
+                                    flags=wx.ICON_INFORMATION, 
+                                    key="debugger")
                 else:
                     # ignore this (async command) and reenable notifications
                     self.post_event = True
         finally:
             pass
             
+    def call(self, method, *args):
+        "Remote call, closing the progress dialog (if any) when done"
+        try:
+            return qdb.Frontend.call(self, method, *args)
+        finally:
+            if self.busy_dialog:
+                self.busy_dialog.Destroy()
+                self.busy_dialog = None
+
+    def busy(self, method, elapsed):
+        "Show the remote call progress, allowing to cancel the evaluation"
+        if not self.busy_dialog:
+            self.busy_dialog = wx.ProgressDialog("Debugger", 
+                    "Still evaluating (%s)..." % method, parent=self.gui,
+                    style=wx.PD_APP_MODAL | wx.PD_CAN_ABORT | 
+                          wx.PD_ELAPSED_TIME)
+            self.busy_dialog.cancelled = False
+        cont = self.busy_dialog.Pulse()[0]
+        if not cont and not self.busy_dialog.cancelled:
+            self.busy_dialog.cancelled = True
+            self.cancel_eval()
+
     def write(self, text):
         "ouputs a message (called by the backend)"
-        self.gui.Write(text)
+        if self.session is self.selected:
+            self.gui.Write(text)
+        else:
+            # keep the console output until the session is selected 
+            self.session.output.append(text)
 
     def readline(self):
         "returns a user input (called by the backend)"
+        if self.session is not self.selected:
+            # the user should know which process is asking for input
+            self.SelectSession(self.session)
         # "raw_input" should be atomic and uninterrupted
         try:
             self.interacting = None
@@ -359,6 +826,19 @@ class Debugger(qdb.Frontend):
             self.gui.ShowInfoBar("cannot jump: %s" % ret,
                          flags=wx.ICON_INFORMATION, key="debugger")
 
+    @check_interaction
+    def Until(self, expression):
+        "Execute until the expression is true (evaluated by the backend)"
+        self.do_until(expression)
+
+    @check_interaction
+    def SetWatchpoint(self, expression):
+        "Stop when the expression value changes (evaluated by the backend)"
+        try:
+            return self.do_set_watchpoint(expression)
+        except qdb.RPCError, e:
+            return u'*** %s' % unicode(e)
+
     def Interrupt(self):
         "Stop immediatelly (similar to Ctrl+C but program con be resumed)"
         if self.attached and not self.is_waiting():
@@ -373,21 +853,28 @@ class Debugger(qdb.Frontend):
             for bp in bps.values():
                 print "loading breakpoint", filename, bp['lineno']
                 self.do_set_breakpoint(filename, bp['lineno'], bp['temp'], bp['cond'])
+                self.session.breakpoints[filename, bp['lineno']] = (
+                                                    bp['temp'], bp['cond'])
 
     @force_interaction
     def SetBreakpoint(self, filename, lineno, temporary=0, cond=None):
-        "Set the specified breakpoint (remotelly)"
+        "Set the specified breakpoint (remotelly, only for this session)"
         self.do_set_breakpoint(filename, lineno, temporary, cond)
+        self.session.breakpoints[filename, lineno] = (temporary, cond)
 
     @force_interaction
     def ClearBreakpoint(self, filename, lineno):
-        "Remove the specified breakpoint (remotelly)"
+        "Remove the specified breakpoint (remotelly, only for this session)"
         self.do_clear_breakpoint(filename, lineno)
+        self.session.breakpoints.pop((filename, lineno), None)
             
     @force_interaction
     def ClearFileBreakpoints(self, filename):
         "Remove all breakpoints set for a file (remotelly)"
         self.do_clear_file_breakpoints(filename)
+        for key in self.session.breakpoints.keys():
+            if key[0] == filename:
+                del self.session.breakpoints[key]
 
     # modal functions required by Eval (must not block):
     
@@ -436,17 +923,25 @@ class Debugger(qdb.Frontend):
     @check_interaction
     def GetContext(self):
         "Request call stack and environment (locals/globals)"
-        self.set_burst(3)
-        w = self.do_where()
+        # send both requests at once (pipelined), then wait the results:
+        w, env = self.Inspect([("do_where", ()), ("do_environment", ())])
         ret = []
-        for filename, lineno, bp, current, source in w:
+        for filename, lineno, bp, current, source in w.result():
             ret.append((filename, lineno, "%s%s" % (bp, current), source))
         d = {'call_stack': ret}
-        env = self.do_environment()
-        ret = ""
-        d['environment'] = env
+        d['environment'] = env.result()
         return d
 
+    def Inspect(self, calls, callback=None):
+        "Pipeline remote calls (i.e. where, environment, eval), don't wait"
+        # callback is called with each future as its result arrives
+        if not self.interacting or not self.pipe or not self.attached:
+            return []
+        # do not repeat the interaction notification after these calls:
+        self.set_burst(len(calls) + 1)
+        return [self.call_async(method, *args, callback=callback)
+                for method, args in calls]
+
     # methods used by the shell:
     
     def Exec(self, statement, write=None, readline=None):
@@ -518,6 +1013,11 @@ class EnvironmentPanel(wx.Panel):
         self.tree.SetMainColumn(0) # the one with the tree in it...
         self.tree.SetColumnWidth(0, 175)
         self.tree.Bind(wx.EVT_TREE_ITEM_ACTIVATED, self.OnActivate)
+        self.tree.Bind(wx.EVT_TREE_ITEM_EXPANDING, self.OnExpanding)
+        self.root = self.tree.AddRoot("The Root Item")
+        self.scopes = {}    # {scope: (item, {var_name: [item, cols, hl]})}
+        self.pending = {}   # variables of collapsed scopes (not shown yet)
+        self.colour = self.tree.GetForegroundColour()
 
     def BuildItem(self, item, txt, cols=None):
         child = self.tree.AppendItem(item, txt)
@@ -527,19 +1027,62 @@ class EnvironmentPanel(wx.Panel):
         return child
         
     def BuildTree(self, scopes, sort_order):
-        self.tree.DeleteAllItems()
-        self.root = self.tree.AddRoot("The Root Item")
-        # process locals and globals
-        for i, key in enumerate(sort_order):
-            vars = scopes.get(key)
-            child = self.BuildItem(self.root, key)
-            if not vars:
-                continue
-            for var_name, (var_repr, var_type) in vars.items():
-                self.BuildItem(child, var_name, (var_type, var_repr))
-            if i == 0:
-                self.tree.Expand(child)
-        self.tree.Expand(self.root)
+        "Update the tree in place (only changed variables are modified)"
+        self.tree.Freeze()
+        try:
+            # process locals and globals
+            for i, key in enumerate(sort_order):
+                vars = scopes.get(key) or {}
+                if key not in self.scopes:
+                    self.scopes[key] = (self.BuildItem(self.root, key), {})
+                    if i == 0:
+                        # show the first scope (i.e. locals) at the begining
+                        self.UpdateScope(key, vars)
+                        self.tree.Expand(self.scopes[key][0])
+                        continue
+                child = self.scopes[key][0]
+                if self.tree.IsExpanded(child):
+                    self.UpdateScope(key, vars)
+                else:
+                    # defer the update until the user expands the scope
+                    self.pending[key] = vars
+                    self.tree.SetItemHasChildren(child, bool(vars))
+            self.tree.Expand(self.root)
+        finally:
+            self.tree.Thaw()
+
+    def UpdateScope(self, key, vars):
+        "Add, remove or modify only the changed variables (highlighting them)"
+        child, items = self.scopes[key]
+        self.pending.pop(key, None)
+        first = not items       # do not remark all the variables at first
+        for var_name in items.keys():
+            if var_name not in vars:
+                self.tree.Delete(items.pop(var_name)[0])
+        for var_name, (var_repr, var_type) in vars.items():
+            cols = (var_type, var_repr)
+            if var_name not in items:
+                item = self.BuildItem(child, var_name, cols)
+                items[var_name] = [item, cols, False]
+                changed = not first
+            else:
+                item, old_cols, highlighted = items[var_name]
+                changed = old_cols != cols
+                if changed:
+                    for i, col in enumerate(cols):
+                        self.tree.SetItemText(item, col, i+1)
+                    items[var_name][1] = cols
+            if changed != items[var_name][2]:
+                # remark the modified values (and restore the unmodified)
+                self.tree.SetItemTextColour(item, wx.RED if changed 
+                                                  else self.colour)
+                items[var_name][2] = changed
+
+    def OnExpanding(self, evt):
+        "Update the variables of a scope when it is shown (see BuildTree)"
+        for key, (child, items) in self.scopes.items():
+            if child == evt.GetItem() and key in self.pending:
+                self.UpdateScope(key, self.pending[key])
 
     def OnSize(self, evt):
         self.tree.SetSize(self.GetSize())
@@ -564,7 +1107,8 @@ class StackListCtrl(wx.ListCtrl, ListCtrlAutoWidthMixin):
     "Call stack window (filename lineno flags, source)"
     def __init__(self, parent, filename=""):
         wx.ListCtrl.__init__(self, parent, -1, 
-            style=wx.LC_REPORT | wx.LC_SINGLE_SEL | wx.LC_ALIGN_LEFT)
+            style=wx.LC_REPORT | wx.LC_SINGLE_SEL | wx.LC_ALIGN_LEFT | 
+                  wx.LC_VIRTUAL)
         ListCtrlAutoWidthMixin.__init__(self)
         self.parent = parent
         self.InsertColumn(0, "Filename", wx.LIST_FORMAT_RIGHT) 
@@ -578,21 +1122,44 @@ class StackListCtrl(wx.ListCtrl, ListCtrlAutoWidthMixin):
         self.InsertColumn(4, "source", wx.LIST_AUTOSIZE) 
         self.SetColumnWidth(4, -1)
         self.setResizeColumn(5)
+        # virtual list: rows are drawn on demand (see OnGetItemText)
+        self.items = []
+        self.changed = set()        # rows modified since the last stop
+        self.changed_attr = wx.ListItemAttr()
+        self.changed_attr.SetTextColour(wx.RED)
 
-    def AddItem(self, item, key=None):
-        index = self.InsertStringItem(sys.maxint, item[0])
-        for i, val in enumerate(item[1:]):
+    def FormatItem(self, item):
+        "Convert the values of a row to text"
+        vals = []
+        for val in item:
             if isinstance(val, str):
                 # Until python 3, encoding is not properly detected by linecache
                 val = val.decode("utf8", "replace")
             elif not isinstance(val, basestring):
                 val = str(val)
-            self.SetStringItem(index, i+1, val)
+            vals.append(val)
+        return vals
     
     def BuildList(self, items):
-        self.DeleteAllItems()
-        for item in items:
-            self.AddItem(item)
+        "Update the list in place (only changed rows are refreshed)"
+        old_items = self.items
+        self.items = [self.FormatItem(item) for item in items]
+        changed = set([i for i, item in enumerate(self.items) 
+                       if i >= len(old_items) or old_items[i] != item])
+        # rows to redraw: modified and previously remarked ones
+        dirty = [i for i in changed | self.changed if i < len(self.items)]
+        self.changed = changed if old_items else set()
+        if len(self.items) != len(old_items):
+            self.SetItemCount(len(self.items))
+        if dirty:
+            self.RefreshItems(min(dirty), max(dirty))
+
+    def OnGetItemText(self, item, col):
+        return self.items[item][col]
+
+    def OnGetItemAttr(self, item):
+        if item in self.changed:
+            return self.changed_attr
 
 
 class TestFrame(wx.Frame):
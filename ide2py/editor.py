@@ -1128,12 +1128,15 @@ class EditorCtrl(stc.StyledTextCtrl):
             expr = self.GetSelectedText()
             if not expr:
                 expr = self.GetWord(whole=True, pos=evt.GetPosition())
-            # Query qdb debugger to evaluate the expression
+            # Query qdb debugger to evaluate the expression (don't wait)
             if expr and self.debugger.interacting:
-                value = self.debugger.Eval(expr)
-                if value is not None:
-                    expr_value = "%s = %s" % (expr, value)
-                    wx.CallAfter(self.SetToolTipString, expr_value)
+                def show(future):
+                    try:
+                        value = future.result()
+                    except Exception, e:
+                        value = u'*** %s' % unicode(e)
+                    self.SetToolTipString("%s = %s" % (expr, value))
+                self.debugger.Inspect([("do_eval", (expr, ))], show)
         evt.Skip()
         
     def OnEndHover(self, evt):
@@ -50,7 +50,7 @@ from console import ConsoleCtrl
 from explorer import ExplorerPanel, EVT_EXPLORE_ID
 from task import TaskMixin
 from gui2py import Gui2pyMixin
-from database import Database
+from database import Database, Profiler
 
 # optional extensions that may have special dependencies (disabled if not meet)
 ADDONS = []
@@ -115,6 +115,10 @@ ID_CONTINUETO = wx.NewId()
 ID_QUIT = wx.NewId()
 ID_INTERRUPT = wx.NewId()
 ID_EVAL = wx.NewId()
+ID_WATCH = wx.NewId()
+ID_UNTIL = wx.NewId()
+ID_SESSIONS = wx.NewId()
+ID_DB_STATS = wx.NewId()
 
 ID_EXPLORER = wx.NewId()
 ID_DESIGNER = wx.NewId()
@@ -231,6 +235,13 @@ class PyAUIFrame(aui.AuiMDIParentFrame, PSPMixin, RepoMixin, TaskMixin,
         dbg_menu.AppendSeparator()
         dbg_menu.Append(ID_EVAL, "Quick &Eval\tShift-F9", 
                         help="Evaluate selected text (expression) in context")
+        dbg_menu.Append(ID_WATCH, "&Watch expression", 
+                        help="Stop when the selected expression changes")
+        dbg_menu.Append(ID_UNTIL, "Continue &until expression", 
+                        help="Execute until the selected expression is true")
+        dbg_menu.AppendSeparator()
+        dbg_menu.Append(ID_SESSIONS, "Select &Session...",
+                        help="Choose the debugged process to interact with")
         dbg_menu.AppendSeparator()
         dbg_menu.Append(ID_BREAKPOINT, "Toggle &Breakpoint\tF9",
                         help="Set or remove a breakpoint in the current line")
@@ -242,6 +253,8 @@ class PyAUIFrame(aui.AuiMDIParentFrame, PSPMixin, RepoMixin, TaskMixin,
         help_menu.Append(wx.ID_HELP, "Quick &Help\tF1",
                         help="help() on selected expression")
         help_menu.AppendSeparator()
+        help_menu.Append(ID_DB_STATS, "&Database Statistics...",
+                        help="Show the statements executed (start profiling)")
         help_menu.Append(wx.ID_ABOUT, "&About...")
         
         win_menu = self.menu['window'] = wx.Menu()
@@ -318,6 +331,8 @@ class PyAUIFrame(aui.AuiMDIParentFrame, PSPMixin, RepoMixin, TaskMixin,
             (ID_SETARGS, self.OnSetArgs),
             (ID_KILL, self.OnKill),
             (ID_ATTACH, self.OnAttachRemoteDebugger),
+            (ID_SESSIONS, self.OnDebugSessions),
+            (ID_DB_STATS, self.OnDatabaseStats),
             (ID_DEBUG, self.OnDebugCommand),
             (ID_EXPLORER, self.OnExplorer),
             (ID_DESIGNER, self.OnDesigner),
@@ -358,12 +373,26 @@ class PyAUIFrame(aui.AuiMDIParentFrame, PSPMixin, RepoMixin, TaskMixin,
 
         for menu_id in [ID_STEPIN, ID_STEPRETURN, ID_STEPNEXT, ID_STEPRETURN,
                         ID_CONTINUE, ID_QUIT, ID_EVAL, ID_JUMP, 
-                        ID_CONTINUETO, ID_INTERRUPT]:
+                        ID_CONTINUETO, ID_INTERRUPT, ID_WATCH, ID_UNTIL]:
             self.Bind(wx.EVT_MENU, self.OnDebugCommand, id=menu_id)
 
         wx.GetApp().SetSplashText("Creating Panes...")
 
-        self.debugger = Debugger(self)
+        cfg_dbg = wx.GetApp().get_config("DEBUGGER")
+        # exception stop policy (lists of comma separated names):
+        policy = {'uncaught_only': cfg_dbg.get("exception_uncaught_only", 
+                                               False)}
+        for rule in ('include', 'exclude', 'modules', 'exclude_modules'):
+            names = cfg_dbg.get("exception_%s" % rule, "").split(",")
+            policy[rule] = [name.strip() for name in names if name.strip()]
+        self.debugger = Debugger(self, capture=cfg_dbg.get("capture"),
+                                 eval_timeout=cfg_dbg.get("eval_timeout", 10),
+                                 exception_policy=policy,
+                                 shared_memory=cfg_dbg.get("shared_memory", 
+                                                           False),
+                                 attach_timeout=cfg_dbg.get("attach_timeout",
+                                                            30),
+                                 max_refresh=cfg_dbg.get("max_refresh", 10))
 
         self.x = 0
         self.call_stack = StackListCtrl(self)
@@ -612,6 +641,19 @@ class PyAUIFrame(aui.AuiMDIParentFrame, PSPMixin, RepoMixin, TaskMixin,
         dlg.ShowModal()
         dlg.Destroy()        
 
+    def OnDatabaseStats(self, event):
+        "Show the database statistics (enabling the instrumentation if needed)"
+        db = wx.GetApp().get_db()
+        if not db.profiler:
+            db.profiler = Profiler()
+            self.ShowInfoBar("database profiling started, check it again later",
+                             flags=wx.ICON_INFORMATION, key="database")
+            return
+        dlg = wx.lib.dialogs.ScrolledMessageDialog(self, db.profiler.report(), 
+                                                   "Database Statistics")
+        dlg.ShowModal()
+        dlg.Destroy()
+
     def GetDockArt(self):
         return self._mgr.GetArtProvider()
 
@@ -789,8 +831,11 @@ class PyAUIFrame(aui.AuiMDIParentFrame, PSPMixin, RepoMixin, TaskMixin,
             if not cdir: 
                 cdir = "."
             cwd = os.getcwd()
+            # transport settings for the child process (i.e. shared memory)
+            env = debug and self.debugger.prepare() or {}
             try:
                 os.chdir(cdir)
+                os.environ.update(env)
                 largs = self.lastprogargs and ' ' + self.lastprogargs or ""
                 if wx.Platform == '__WXMSW__':
                     pythexec = sys.prefix.replace("\\", "/") + "/pythonw.exe"
@@ -801,13 +846,18 @@ class PyAUIFrame(aui.AuiMDIParentFrame, PSPMixin, RepoMixin, TaskMixin,
                     filename + '"'  + largs), filen)
                 self.statusbar.SetStatusText("Executing: %s" % (filename), 1)
                 if debug:
-                    self.debugger.attach()
+                    self.debugger.attach(pid=self.pid)
 
             except Exception, e:
                 raise
                 #ShowMessage("Error Setting current directory for Execute")
             finally:
                 os.chdir(cwd)
+                if debug:
+                    # remove the shared memory files if they were not used
+                    self.debugger.release()
+                for key in env:
+                    del os.environ[key]
     
     def OnKill(self, event):
         if self.console.process:
@@ -832,6 +882,9 @@ class PyAUIFrame(aui.AuiMDIParentFrame, PSPMixin, RepoMixin, TaskMixin,
                 "Clean up on termination (prevent SEGV!)"
                 console.process = None
                 parent.executing = False
+                # do not wait the debugger connection if it failed to start
+                parent.debugger.AbortAttach("process terminated (status %s)"
+                                            % status)
                 statusbar.SetStatusText("Terminated: %s!" % filename, 0)
                 statusbar.SetStatusText("", 1)
         
@@ -860,13 +913,11 @@ class PyAUIFrame(aui.AuiMDIParentFrame, PSPMixin, RepoMixin, TaskMixin,
         if event and running:
             filename, lineno, context, orig_line = event.data
             if context:
-                call_stack = context['call_stack']
-                environment = context['environment']
-            else:
-                call_stack = environment = {}
-            self.call_stack.BuildList(call_stack)
-            self.environment.BuildTree(environment,
-                                       sort_order=('locals', 'globals'))
+                # update the panes in place (highlighting the changes), they
+                # are kept between interactions (cleared when session ends)
+                self.call_stack.BuildList(context['call_stack'])
+                self.environment.BuildTree(context['environment'],
+                                           sort_order=('locals', 'globals'))
         elif not running:
             filename, lineno, offset = event
         # first, clean all current debugging markers
@@ -947,6 +998,17 @@ class PyAUIFrame(aui.AuiMDIParentFrame, PSPMixin, RepoMixin, TaskMixin,
                                    wx.ICON_INFORMATION | wx.OK )
             dlg.ShowModal()
             dlg.Destroy()
+        elif event_id == ID_WATCH and self.active_child:
+            # Stop when the selected expression changes (watchpoint)
+            arg = self.active_child.GetSelectedText()
+            val = self.debugger.SetWatchpoint(arg)
+            self.ShowInfoBar("watching %s = %s" % (arg, val),
+                             flags=wx.ICON_INFORMATION, key="debugger")
+        elif event_id == ID_UNTIL and self.active_child:
+            # Continue until the selected expression is true
+            arg = self.active_child.GetSelectedText()
+            self.GotoFileLine()
+            self.debugger.Until(arg)
         elif event_id == ID_JUMP and self.debugging_child:
             # change actual line number (if possible)
             lineno = self.debugging_child.GetCurrentLine()
@@ -1073,18 +1135,50 @@ class PyAUIFrame(aui.AuiMDIParentFrame, PSPMixin, RepoMixin, TaskMixin,
                 'Attach to remote debugger', 
                 'host="localhost", port=6000, authkey="secret password"')
         if dlg.ShowModal() == wx.ID_OK:
-            # detach any running debugger
-            self.debugger.detach()
-            # step on connection:
-            self.debugger.start_continue = False
-            # get and parse the URL (TODO: better configuration)
-            d = eval("dict(%s)" % dlg.GetValue(), {}, {})
-            # attach local thread (wait for connections)
-            self.debugger.attach(d['host'], d['port'], d['authkey'])
+            # parse the address (i.e. host="localhost", port=6000, ...)
+            params = {}
+            for param in dlg.GetValue().split(","):
+                key, sep, value = param.partition("=")
+                params[key.strip()] = value.strip().strip("\"'")
+            try:
+                host = params.get('host') or None
+                port = int(params['port']) if params.get('port') else None
+            except ValueError, e:
+                self.ShowInfoBar("invalid debugger address: %s" % e,
+                                 flags=wx.ICON_ERROR, key="debugger")
+                dlg.Destroy()
+                return
+            # start a new session (other sessions keep running, the user
+            # could be interacting with one of them), step on connection:
+            self.debugger.init(cont=False, select=False)
+            # wait for connections at the given address:
+            self.debugger.attach(host or "localhost", port, 
+                                 params.get('authkey'), local=False)
             # set flag to not start new processes on debug command
             self.executing = True
         dlg.Destroy()
 
+    def OnDebugSessions(self, event):
+        "Choose the session (debugged process) to interact with"
+        sessions = self.debugger.sessions
+        if not sessions:
+            self.ShowInfoBar("no debugger sessions attached",
+                             flags=wx.ICON_INFORMATION, key="debugger")
+            return
+        choices = []
+        for session in sessions:
+            state = "stopped" if session.interacting else "running"
+            choices.append("%s (%s, %d breakpoints)" % (session.name, state,
+                                                  len(session.breakpoints)))
+        dlg = wx.SingleChoiceDialog(self, "Debugged processes:", 
+                                    "Debugger Sessions", choices, 
+                                    wx.CHOICEDLG_STYLE)
+        if self.debugger.selected in sessions:
+            dlg.SetSelection(sessions.index(self.debugger.selected))
+        if dlg.ShowModal() == wx.ID_OK:
+            self.debugger.SelectSession(sessions[dlg.GetSelection()])
+        dlg.Destroy()
+
     def NotifyRepo(self, filename, action="", status=""):
         if 'repo' in ADDONS:
             wx.PostEvent(self, RepoEvent(filename, action, status))
@@ -1546,6 +1640,8 @@ class MainApp(wx.App):
 
     def OnExit(self):
         self.write_config()
+        # write any pending change to the database (background writer)
+        self.db.shutdown()
 
     def get_config(self, section):
         return FancyConfigDict(section, self.config)
@@ -23,6 +23,7 @@ from wx.lib.agw.pygauge import PyGauge
 import images
 import simplejsonrpc
 from database import Shelf
+from schema import create_psp_tables
 
 try:
     from camera import Camera           # camera sensor needs OpenCV
@@ -541,15 +542,7 @@ class PSPMixin(object):
         cfg = wx.GetApp().get_config("PSP")
         
         # create psp tables structure
-        self.db.create("defect", defect_id=int, task_id=int,
-                       number=int, summary=str, description=str,
-                       date=str, type=int, inject_phase=str, remove_phase=str,
-                       fix_time=float, fix_defect=int, checked=bool,
-                       filename=str, lineno=int, offset=int, uuid=str)
-        
-        self.db.create("time_summary", time_summary_id=int, task_id=int,
-                       phase=str, plan=float, actual=float, off_task=float,
-                       interruption=float, )
+        create_psp_tables(self.db)
 
         # metadata directory (convert to full path)
         self.psp_metadata_dir = cfg.get("metadata", "medatada")
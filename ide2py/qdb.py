@@ -21,8 +21,24 @@ import os
 import sys
 import traceback
 import cmd
+import mmap
 import pydoc
+import select
+import struct
+import tempfile
 import threading
+import time
+import Queue
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import ctypes       # needed to interrupt evaluations (time budget)
+except ImportError:
+    ctypes = None
 
 
 # Speed Ups: global variables
@@ -34,7 +50,7 @@ class Qdb(bdb.Bdb):
     "Qdb Debugger Backend"
 
     def __init__(self, pipe, redirect_stdio=True, allow_interruptions=False,
-                 use_speedups=True, skip=[__name__]):
+                 use_speedups=True, skip=[__name__], detach_on_close=False):
         global breaks, poll
         kwargs = {}
         if sys.version_info > (2, 7):
@@ -58,6 +74,7 @@ class Qdb(bdb.Bdb):
             self.breaks[None] = []
         self.allow_interruptions = allow_interruptions
         self.burst = 0          # do not send notifications ("burst" mode)
+        self.batch = None       # commands to be run locally (see do_batch)
         self.params = {}        # optional parameters for interaction
         
         # if available and enabled, enable speedups:
@@ -65,12 +82,35 @@ class Qdb(bdb.Bdb):
         # flags to reduce overhead (only stop at breakpoint or interrupt)
         self.use_speedups = use_speedups
         self.fast_continue = False
+        # on-demand attach: resume the program if the frontend goes away
+        self.detach_on_close = detach_on_close
+        self.detached = False
+        # evaluation time budget and cancellation (see Watchdog)
+        self.watchdog = None
+        self.inbox = Queue.Queue()  # requests received while evaluating
+        # check the requests on each line (the inbox only if not empty):
+        self.poll_requests = self.pipe.poll
+        # data watchpoints / conditions {code: [watch]} (see check_watchpoints)
+        self.watchpoints = {}
+        self.watch_hit = None
+        # rules to stop on exceptions (see stop_exception), cached by type
+        self.exception_policy = {'uncaught_only': False, 
+                                 'include': (), 'exclude': (),
+                                 'modules': (), 'exclude_modules': ()}
+        self.exception_cache = {}
 
     def pull_actions(self):
         # receive a remote procedure call from the frontend:
         # returns True if action processed
         #         None when 'run' notification is received (see 'startup')
-        request = self.pipe.recv()
+        try:
+            request = self.recv()
+        except (EOFError, IOError):
+            if not self.detach_on_close:
+                raise
+            # frontend disconnected, do not abort the running program
+            self.do_detach()
+            return True
         if request.get("method") == 'run':
             return None
         response = {'version': '1.1', 'id': request.get('id'), 
@@ -83,19 +123,47 @@ class Qdb(bdb.Bdb):
                                         **request.get('kwargs', {}))
         except Exception, e:
             response['error'] = {'code': 0, 'message': str(e)}
+        if request['method'] == 'do_batch' and self.batch:
+            # batch response will be sent when done (see run_batch)
+            self.batch['id'] = request.get('id')
         # send the result for normal method calls, not for notifications
-        if request.get('id'):
+        elif request.get('id'):
             self.pipe.send(response)
         return True
 
+    def pending(self):
+        "Check if there is a request to process (queued or in the pipe)"
+        return not self.inbox.empty() or self.pipe.poll()
+
+    def recv(self):
+        "Read a request (queued by the watchdog if it was evaluating)"
+        if self.watchdog or not self.inbox.empty():
+            request = self.inbox.get()
+            if not self.watchdog and self.inbox.empty():
+                # all the queued requests processed, only poll the pipe
+                self.poll_requests = self.pipe.poll
+            return request
+        return self.pipe.recv()
+
     # Override Bdb methods
 
     def trace_dispatch(self, frame, event, arg):
+        if self.detached:
+            # tracing was removed (see do_detach), clean up this frame
+            frame.f_trace = None
+            return None
+        # check watchpoints (only in the registered code, no pipe traffic)
+        if self.watchpoints and event == 'line' and \
+                frame.f_code in self.watchpoints and \
+                self.check_watchpoints(frame):
+            self.fast_continue = False
+            self.set_step()
+            return self.dispatch_line(frame)
         # check for non-interaction rpc (set_breakpoint, interrupt)
-        while self.allow_interruptions and self.pipe.poll():
+        while self.allow_interruptions and self.poll_requests():
             self.pull_actions()
             # check for non-interaction rpc (set_breakpoint, interrupt)
-            while poll():
+            while self.poll_requests():
                 self.pull_actions()
         if (frame.f_code.co_filename, frame.f_lineno) not in breaks and \
             self.fast_continue:
@@ -115,6 +183,11 @@ class Qdb(bdb.Bdb):
             return self.dispatch_exception(frame, arg)
         return self.trace_dispatch
 
+    def break_anywhere(self, frame):
+        # keep tracing functions with watchpoints (even if no breakpoints)
+        return (frame.f_code in self.watchpoints or
+                bdb.Bdb.break_anywhere(self, frame))
+
     def user_call(self, frame, argument_list):
         """This method is called when there is the remote possibility
         that we ever need to stop in this function."""
@@ -136,12 +209,15 @@ class Qdb(bdb.Bdb):
             self._wait_for_breakpoint = 0
         self.interaction(frame)
 
-    def user_exception(self, frame, info):
+    def user_exception(self, frame, info, uncaught=False):
         """This function is called if an exception occurs,
         but only if we are to stop at or just below this level."""
         if self._wait_for_mainpyfile or self._wait_for_breakpoint:
             return
         extype, exvalue, trace = info
+        # check the policy before any expensive formatting / pickling:
+        if not uncaught and not self.stop_exception(frame, extype):
+            return
         # pre-process stack trace as it isn't pickeable (cannot be sent pure)
         msg = ''.join(traceback.format_exception(extype, exvalue, trace))
         trace = traceback.extract_tb(trace)
@@ -189,7 +265,10 @@ class Qdb(bdb.Bdb):
         self.pipe.send({'method': 'startup', 'args': (__version__, )})
         while self.pull_actions() is not None:
             pass
-        self.run(statement)
+        try:
+            self.run(statement)
+        finally:
+            self.finish_batch("The program finished")
 
     # General interaction function
 
@@ -209,6 +288,10 @@ class Qdb(bdb.Bdb):
         self.frame = frame
         try:
             while self.waiting:
+                if self.batch:
+                    # run the pending commands locally (no notifications)
+                    self.run_batch()
+                    continue
                 #  sync_source_line()
                 if frame and filename[:1] + filename[-1:] != "<>" and os.path.exists(filename):
                     line = linecache.getline(filename, self.frame.f_lineno,
@@ -223,6 +306,9 @@ class Qdb(bdb.Bdb):
                         kwargs['call_stack'] = self.do_where()
                     if self.params.get('environment'):
                         kwargs['environment'] = self.do_environment()
+                    if self.watch_hit:
+                        kwargs['watch'] = self.watch_hit
+                        self.watch_hit = None
                     self.pipe.send({'method': 'interaction', 'id': None,
                                 'args': (filename, self.frame.f_lineno, line),
                                 'kwargs': kwargs})
@@ -231,6 +317,8 @@ class Qdb(bdb.Bdb):
         finally:
             self.waiting = False
         self.frame = None
+        if self.detached:
+            self.pipe.close()
 
     def do_debug(self, mainpyfile=None, wait_breakpoint=1):
         self.reset()
@@ -278,10 +366,22 @@ class Qdb(bdb.Bdb):
         self.fast_continue = False
 
     def do_quit(self):
+        self.finish_batch("Quit")
         self.set_quit()
         self.waiting = False
         self.fast_continue = False
 
+    def do_detach(self):
+        "Remove tracing and resume the program normally (do not quit)"
+        self.detached = True
+        self.waiting = False
+        self.fast_continue = False
+        sys.settrace(None)
+        frame = self.frame
+        while frame:
+            frame.f_trace = None
+            frame = frame.f_back
+
     def do_jump(self, lineno):
         arg = int(lineno)
         try:
@@ -341,6 +441,94 @@ class Qdb(bdb.Bdb):
     def do_clear_file_breakpoints(self, filename):
         self.clear_all_file_breaks(filename)
 
+    def do_set_watchpoint(self, expression, until=False, frame=None):
+        "Stop when the expression changes (or is true) in the current function"
+        frame = frame or self.frame
+        if not frame:
+            raise RPCError("No current frame available to watch")
+        watch = {'expression': expression, 'until': until,
+                 'code': compile(expression, '<watch>', 'eval')}
+        watch['value'] = self._watch_eval(watch, frame)
+        self.watchpoints.setdefault(frame.f_code, []).append(watch)
+        # fake breakpoint to prevent removing trace_dispatch on set_continue
+        self.breaks.setdefault(None, [])
+        return pydoc.cram(repr(watch['value']), 255)
+
+    def do_clear_watchpoint(self, expression=None):
+        "Remove the watchpoint (or all if no expression is given)"
+        for code, watches in self.watchpoints.items():
+            if expression is not None:
+                watches[:] = [watch for watch in watches
+                              if watch['expression'] != expression]
+            else:
+                del watches[:]
+        self._prune_watchpoints()
+
+    def _prune_watchpoints(self):
+        for code, watches in self.watchpoints.items():
+            if not watches:
+                del self.watchpoints[code]
+        if not self.watchpoints and not self.allow_interruptions:
+            # remove the fake breakpoint (see do_set_watchpoint)
+            self.breaks.pop(None, None)
+
+    def do_list_watchpoint(self):
+        watches = []
+        for code, code_watches in self.watchpoints.items():
+            for watch in code_watches:
+                watches.append((code.co_filename, code.co_name, 
+                                watch['expression'], watch['until'],
+                                pydoc.cram(repr(watch['value']), 255)))
+        return watches
+
+    def do_until(self, expression):
+        "Continue execution until the expression is true (current function)"
+        self.do_set_watchpoint(expression, until=True)
+        self.do_continue()
+
+    def _watch_eval(self, watch, frame):
+        try:
+            return eval(watch['code'], frame.f_globals, frame.f_locals)
+        except Exception, e:
+            # the expression could not be evaluated yet (i.e. NameError)
+            return e
+
+    def _watch_changed(self, old, new):
+        "Compare the watched values (failing the same way is not a change)"
+        if isinstance(old, Exception) or isinstance(new, Exception):
+            return (type(old), str(getattr(old, "args", old))) != \
+                   (type(new), str(getattr(new, "args", new)))
+        try:
+            return new is not old and new != old
+        except Exception:
+            return True
+
+    def check_watchpoints(self, frame):
+        "Evaluate the watchpoints for the frame, True if any was triggered"
+        hit = None
+        watches = self.watchpoints[frame.f_code]
+        for watch in watches[:]:
+            value = self._watch_eval(watch, frame)
+            if watch['until']:
+                if value and not isinstance(value, Exception):
+                    # condition met, it is not longer needed
+                    watches.remove(watch)
+                    hit = (watch['expression'], None, repr(value))
+            else:
+                changed = self._watch_changed(watch['value'], value)
+                if changed:
+                    hit = (watch['expression'], repr(watch['value']), 
+                           repr(value))
+                    watch['value'] = value
+        if not watches:
+            # remove the temporary conditions already met
+            self._prune_watchpoints()
+        if hit:
+            self.watch_hit = (hit[0], pydoc.cram(hit[1] or '', 255),
+                              pydoc.cram(hit[2], 255))
+            return True
+        return False
+
     def do_clear(self, arg):
         # required by BDB to remove temp breakpoints!
         err = self.clear_bpbynumber(arg)
@@ -349,8 +537,8 @@ class Qdb(bdb.Bdb):
 
     def do_eval(self, arg, safe=True):
         if self.frame:
-            ret = eval(arg, self.frame.f_globals,
-                        self.frame_locals)
+            ret = self.evaluate(eval, arg, self.frame.f_globals,
+                                self.frame_locals)
         else:
             ret = RPCError("No current frame available to eval")
         if safe:
@@ -368,7 +556,7 @@ class Qdb(bdb.Bdb):
             self.displayhook_value = None
             try:
                 sys.displayhook = self.displayhook
-                exec code in globals, locals
+                self.evaluate(self._exec, code, globals, locals)
                 ret = self.displayhook_value
             finally:
                 sys.displayhook = save_displayhook
@@ -376,6 +564,33 @@ class Qdb(bdb.Bdb):
             ret = pydoc.cram(repr(ret), 255)
         return ret
 
+    def _exec(self, code, globals, locals):
+        exec code in globals, locals
+
+    def evaluate(self, function, *args):
+        "Call function limiting its time budget (it can be cancelled too)"
+        if self.watchdog:
+            # nested evaluation (i.e. autocompletion), already guarded
+            return function(*args)
+        self.watchdog = Watchdog(self, self.params.get('eval_timeout'))
+        self.watchdog.start()
+        try:
+            try:
+                return function(*args)
+            finally:
+                self.watchdog.stop()
+        except EvalInterrupted:
+            self.watchdog.stop()
+            raise RPCError("Evaluation interrupted: %s" % self.watchdog.reason)
+        finally:
+            self.watchdog = None
+
+    def cancel_eval(self, interrupted=False):
+        "Stop the current evaluation (handled by the watchdog, if any)"
+        # already processed by the watchdog: answer if it was interrupted
+        # (False if there was nothing to cancel)
+        return interrupted
+
     def do_where(self):
         "print_stack_trace"
         stack, curindex = self.get_stack(self.frame, None)
@@ -463,6 +678,127 @@ class Qdb(bdb.Bdb):
                     pass
             return (name, argspec[1:-1], doc.strip())
 
+    def set_exception_policy(self, policy):
+        "Set the rules to stop on exceptions (see stop_exception)"
+        self.exception_policy.update(policy)
+        self.exception_cache.clear()
+
+    def stop_exception(self, frame, extype):
+        "Check if the exception policy allows to stop (caught exceptions)"
+        module = frame.f_globals.get('__name__') or ''
+        key = (extype, module)
+        if key in self.exception_cache:
+            return self.exception_cache[key]
+        policy = self.exception_policy
+        # exception names (including base classes, i.e. LookupError):
+        names = set()
+        if inspect.isclass(extype):
+            for cls in inspect.getmro(extype):
+                names.add(cls.__name__)
+                names.add("%s.%s" % (cls.__module__, cls.__name__))
+        else:
+            names.add(str(extype))    # old string exceptions
+        # module prefixes (i.e. "django" matches "django.db.models"):
+        in_modules = lambda prefixes: [prefix for prefix in prefixes 
+                        if module == prefix or module.startswith(prefix + ".")]
+        if policy['uncaught_only']:
+            # uncaught exceptions are handled by post_mortem
+            stop = False
+        elif policy['include'] and not names.intersection(policy['include']):
+            stop = False
+        elif names.intersection(policy['exclude']):
+            stop = False
+        elif policy['modules'] and not in_modules(policy['modules']):
+            stop = False
+        elif in_modules(policy['exclude_modules']):
+            stop = False
+        else:
+            stop = True
+        self.exception_cache[key] = stop
+        return stop
+
+    def do_batch(self, commands):
+        "Run a list of commands locally, returning all the results at once"
+        # commands are like requests, i.e. {'method': 'do_eval', 'args': ()}
+        # steps can be repeated ('count'), until a line is reached ('lineno')
+        # collecting the values of expressions at each stop ('collect')
+        for command in commands:
+            if command['method'] in ('do_batch', 'run'):
+                raise RPCError("Invalid batch command: %s" % command['method'])
+        self.batch = {'commands': [dict(command) for command in commands],
+                      'results': [], 'id': None}
+
+    def run_batch(self):
+        "Execute the batch commands until the program is resumed or done"
+        batch = self.batch
+        while batch['commands'] and self.waiting:
+            command = batch['commands'][0]
+            method = command['method']
+            if method in ('do_step', 'do_next', 'do_return', 'do_continue'):
+                if 'stops' not in command:
+                    # first time, compile the expressions and start stepping
+                    command['stops'] = []
+                    command['codes'] = [compile(expr, '<batch>', 'eval')
+                                        for expr in command.get('collect', ())]
+                    count = command.get('count')
+                    if count is None and not command.get('lineno'):
+                        count = 1
+                    command['remaining'] = count
+                else:
+                    # stopped again, collect the current state:
+                    frame = self.frame
+                    try:
+                        values = self.evaluate(self._collect, command['codes'])
+                    except RPCError, e:
+                        values = [u'*** %s' % e] * len(command['codes'])
+                    command['stops'].append((frame.f_code.co_filename,
+                                             frame.f_lineno, values))
+                    if command['remaining'] is not None:
+                        command['remaining'] -= 1
+                    if command.get('lineno') == frame.f_lineno:
+                        command['remaining'] = 0
+                if command['remaining'] != 0:
+                    # resume the execution (the batch continues at next stop)
+                    getattr(self, method)()
+                    if not sys.gettrace():
+                        # tracing removed (continue without breakpoints)
+                        self.finish_batch("No more stops (program resumed)")
+                    return
+                result = command['stops']
+            else:
+                try:
+                    result = getattr(self, method)(*command.get('args', ()), 
+                                                   **command.get('kwargs', {}))
+                except Exception, e:
+                    batch['commands'].pop(0)
+                    batch['results'].append({'result': None, 
+                                 'error': {'code': 0, 'message': str(e)}})
+                    continue
+            batch['commands'].pop(0)
+            batch['results'].append({'result': result, 'error': None})
+        if not batch['commands']:
+            self.finish_batch()
+
+    def _collect(self, codes):
+        values = []
+        for code in codes:
+            try:
+                value = eval(code, self.frame.f_globals, self.frame_locals)
+                values.append(pydoc.cram(repr(value), 255))
+            except Exception, e:
+                values.append(u'*** %s' % e)
+        return values
+
+    def finish_batch(self, error=None):
+        "Send the aggregated response (error for the commands not done)"
+        batch, self.batch = self.batch, None
+        if batch and batch['id']:
+            for command in batch['commands']:
+                batch['results'].append({'result': command.get('stops'),
+                                 'error': {'code': 0, 'message': error}})
+            self.pipe.send({'version': '1.1', 'id': batch['id'],
+                            'result': batch['results'], 'error': None})
+
     def set_burst(self, val):
         "Set burst mode -multiple command count- (shut up notifications)"
         self.burst = val
@@ -509,14 +845,22 @@ class Qdb(bdb.Bdb):
         # SyntaxError doesn't execute even one line, so avoid mainpyfile check
         self._wait_for_mainpyfile = False
         # send exception information & request interaction
-        self.user_exception(frame, info)
+        self.user_exception(frame, info, uncaught=True)
 
     # console file-like object emulation
     def readline(self):
         "Replacement for stdin.readline()"
         msg = {'method': 'readline', 'args': (), 'id': self.i}
-        self.pipe.send(msg)
-        msg = self.pipe.recv()
+        watchdog = self.watchdog
+        if watchdog:
+            # waiting the user input is not part of the time budget
+            watchdog.pause()
+        try:
+            self.pipe.send(msg)
+            msg = self.recv()
+        finally:
+            if watchdog:
+                watchdog.resume()
         self.i += 1
         return msg['result']
 
@@ -544,6 +888,83 @@ class Qdb(bdb.Bdb):
     def encoding(self):
         return None  # use default, 'utf-8' should be better...
 
+class EvalInterrupted(BaseException):
+    "Raised asynchronously in the debuggee to stop a runaway evaluation"
+    pass
+
+
+class Watchdog(threading.Thread):
+    "Interrupt an evaluation if it exceeds its time budget or is cancelled"
+
+    def __init__(self, qdb, timeout=None, interval=0.05):
+        threading.Thread.__init__(self, name="qdb-watchdog")
+        self.daemon = True
+        self.qdb = qdb
+        self.timeout = timeout
+        self.interval = interval
+        self.thread_id = threading.current_thread().ident  # debuggee thread
+        self.lock = threading.Lock()
+        self.active = True
+        self.reason = None
+        self.started = time.time()  # start of the budget (see pause)
+        self.paused = None          # waiting the user input since
+
+    def run(self):
+        while self.active:
+            # the debuggee is busy, read the pipe looking for a cancellation
+            if self.qdb.pipe.poll():
+                request = self.qdb.pipe.recv()
+                if request.get('method') == 'cancel_eval':
+                    self.interrupt("cancelled")
+                    # the answer is sent by the debuggee (see cancel_eval)
+                    request['kwargs'] = {'interrupted': 
+                                         self.reason == "cancelled"}
+                self.qdb.inbox.put(request)
+                # check the inbox too (until it is emptied, see Qdb.recv)
+                self.qdb.poll_requests = self.qdb.pending
+            else:
+                time.sleep(self.interval)
+            if self.timeout and not self.paused and \
+                    time.time() - self.started > self.timeout:
+                self.interrupt("time budget exceeded (%s s)" % self.timeout)
+
+    def pause(self):
+        "Stop counting the time budget (i.e. waiting the user input)"
+        self.paused = time.time()
+
+    def resume(self):
+        "Continue counting the time budget (excluding the paused time)"
+        self.started += time.time() - self.paused
+        self.paused = None
+
+    def interrupt(self, reason):
+        "Raise EvalInterrupted in the debuggee (on the next bytecode)"
+        self.lock.acquire()
+        try:
+            if self.active and not self.reason:
+                self.reason = reason
+                if ctypes:
+                    ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                        ctypes.c_long(self.thread_id), 
+                        ctypes.py_object(EvalInterrupted))
+        finally:
+            self.lock.release()
+
+    def stop(self):
+        "Finish the evaluation, discarding any pending interruption"
+        self.lock.acquire()
+        try:
+            if self.active:
+                self.active = False
+                if self.reason and ctypes:
+                    ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                        ctypes.c_long(self.thread_id), None)
+        finally:
+            self.lock.release()
+        # wait the pipe to be released (it could be receiving a request)
+        self.join()
+
+
 class QueuePipe(object):
     "Simulated pipe for threads (using two queues)"
     
@@ -551,25 +972,384 @@ class QueuePipe(object):
         self.__name = name
         self.in_queue = in_queue
         self.out_queue = out_queue
+        self.buffer = []            # data already received by poll
 
     def send(self, data):
         self.out_queue.put(data, block=True)
 
     def recv(self, count=None, timeout=None):
+        if self.buffer:
+            return self.buffer.pop(0)
         data = self.in_queue.get(block=True, timeout=timeout)
         return data
 
     def poll(self, timeout=None):
-        return not self.in_queue.empty()
+        if self.buffer or not self.in_queue.empty():
+            return True
+        if timeout:
+            # wait for data (up to timeout seconds)
+            try:
+                self.buffer.append(self.in_queue.get(block=True, 
+                                                     timeout=timeout))
+            except Queue.Empty:
+                return False
+            return True
+        return False
 
     def close(self):
         pass
 
 
+class SharedMemoryPipe(object):
+    "Pipe for local sessions using memory-mapped ring buffers (no sockets)"
+
+    # ring header: head (bytes written), tail (bytes read), reader waiting,
+    #              writer closed, writer pid (padded to 64 bytes)
+    HEADER = struct.Struct("=QQIII")
+    HEADER_SIZE = 64
+    HEAD, TAIL, WAITING, CLOSED, PID = [(0, "=Q"), (8, "=Q"), (16, "=I"), 
+                                        (20, "=I"), (24, "=I")]
+    LENGTH = struct.Struct("=I")
+    SPIN = 200 if (os.sysconf("SC_NPROCESSORS_ONLN") 
+                   if hasattr(os, "sysconf") else 2) > 1 else 0
+
+    def __init__(self, filename, frontend=False):
+        self.filename = filename
+        self.frontend = frontend        # the frontend owns the files
+        f = open(filename, "r+b")
+        try:
+            self.mm = mmap.mmap(f.fileno(), 0)
+        finally:
+            f.close()
+        self.size = len(self.mm) / 2 - self.HEADER_SIZE
+        # first ring: frontend -> backend, second ring: backend -> frontend
+        rings = [0, self.HEADER_SIZE + self.size]
+        if not frontend:
+            rings.reverse()
+        self.out_ring, self.in_ring = rings
+        # doorbells to wake up the reader (named pipes, if supported)
+        self.doorbells = {}
+        for i, ring in enumerate((0, self.HEADER_SIZE + self.size)):
+            if os.path.exists("%s.%s" % (filename, i)):
+                self.doorbells[ring] = os.open("%s.%s" % (filename, i), 
+                                               os.O_RDWR | os.O_NONBLOCK)
+        self.set_field(self.out_ring, self.PID, os.getpid())
+        self.peer_checked = time.time()
+        self.peer_pid = None    # child process (if known before it connects)
+
+    @classmethod
+    def create(cls, size=1024 * 1024):
+        "Create the shared memory (and doorbells) returning the frontend side"
+        fd, filename = tempfile.mkstemp(prefix="qdb", suffix=".shm")
+        os.write(fd, "\0" * (2 * (cls.HEADER_SIZE + size)))
+        os.close(fd)
+        if hasattr(os, "mkfifo"):
+            for i in range(2):
+                os.mkfifo("%s.%s" % (filename, i), 0600)
+        return cls(filename, frontend=True)
+
+    def get_field(self, ring, field):
+        offset, fmt = field
+        return struct.unpack_from(fmt, self.mm, ring + offset)[0]
+
+    def set_field(self, ring, field, value):
+        offset, fmt = field
+        struct.pack_into(fmt, self.mm, ring + offset, value)
+
+    def copy(self, ring, pos, data=None, length=0):
+        "Write (or read) bytes in the ring (wrapping around the end)"
+        start = ring + self.HEADER_SIZE
+        pos = pos % self.size
+        n = len(data) if data is not None else length
+        first = min(n, self.size - pos)
+        if data is not None:
+            self.mm[start + pos:start + pos + first] = data[:first]
+            self.mm[start:start + n - first] = data[first:]
+        else:
+            return (self.mm[start + pos:start + pos + first] + 
+                    self.mm[start:start + n - first])
+
+    def send(self, data):
+        if not self.mm:
+            raise IOError("shared memory pipe closed")
+        payload = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        record = self.LENGTH.pack(len(payload)) + payload
+        if len(record) > self.size:
+            raise ValueError("Message too big for the shared memory pipe")
+        ring = self.out_ring
+        head, tail = self.HEADER.unpack_from(self.mm, ring)[:2]
+        while self.size - (head - tail) < len(record):
+            # ring full, wait the reader
+            time.sleep(0.001)
+            tail = self.get_field(ring, self.TAIL)
+        self.copy(ring, head, record)
+        # publish the message and wake up the reader (if it is sleeping)
+        self.set_field(ring, self.HEAD, head + len(record))
+        if self.get_field(ring, self.WAITING) and ring in self.doorbells:
+            try:
+                os.write(self.doorbells[ring], "!")
+            except OSError:
+                pass    # doorbell already ringing
+
+    def recv(self, count=None, timeout=None):
+        if not self.mm:
+            raise IOError("shared memory pipe closed")
+        while not self.poll(1):
+            pass
+        ring = self.in_ring
+        head, tail = self.HEADER.unpack_from(self.mm, ring)[:2]
+        if head == tail:
+            raise EOFError("shared memory pipe closed")
+        length = self.LENGTH.unpack(self.copy(ring, tail, length=4))[0]
+        data = self.copy(ring, tail + 4, length=length)
+        self.set_field(ring, self.TAIL, tail + 4 + length)
+        return pickle.loads(data)
+
+    def poll(self, timeout=None):
+        ring = self.in_ring
+        t0 = time.time()
+        while True:
+            head, tail, waiting, closed, pid = \
+                self.HEADER.unpack_from(self.mm, ring)
+            if pid and self.frontend:
+                # the backend has opened the files, they are not needed
+                self.unlink()
+            if head != tail or closed or not self.is_peer_alive(pid):
+                return True
+            # spin a little before sleeping (replies usually come quickly)
+            for i in xrange(self.SPIN):
+                if self.get_field(ring, self.HEAD) != tail:
+                    return True
+            remaining = timeout - (time.time() - t0) if timeout else 0
+            if remaining <= 0:
+                return False
+            # sleep until the writer rings the doorbell (or timeout)
+            self.set_field(ring, self.WAITING, 1)
+            if self.get_field(ring, self.HEAD) == tail:
+                if ring in self.doorbells:
+                    fd = self.doorbells[ring]
+                    if select.select([fd], [], [], min(remaining, 0.1))[0]:
+                        try:
+                            os.read(fd, 4096)
+                        except OSError:
+                            pass
+                else:
+                    time.sleep(min(remaining, 0.001))
+            self.set_field(ring, self.WAITING, 0)
+
+    def fileno(self):
+        "Return the doorbell to select on (the writer will ring it)"
+        ring = self.in_ring
+        if not self.mm or ring not in self.doorbells:
+            raise IOError("shared memory pipe not selectable")
+        fd = self.doorbells[ring]
+        try:
+            os.read(fd, 4096)   # clear previous rings (non blocking)
+        except OSError:
+            pass
+        # ask the writer to ring (check poll() after this to avoid races)
+        self.set_field(ring, self.WAITING, 1)
+        return fd
+
+    def is_peer_alive(self, pid):
+        "Check (every second) that the other process didn't die (POSIX)"
+        pid = pid or self.peer_pid
+        if not pid or not hasattr(os, "mkfifo") or \
+                time.time() - self.peer_checked < 1:
+            return True
+        self.peer_checked = time.time()
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def unlink(self):
+        "Remove the files (the mappings and open doorbells are still valid)"
+        for filename in (self.filename, self.filename + ".0", 
+                         self.filename + ".1"):
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+    def close(self):
+        if self.mm:
+            try:
+                self.set_field(self.out_ring, self.CLOSED, 1)
+                for fd in self.doorbells.values():
+                    os.close(fd)
+                self.mm.close()
+                self.mm = None
+            finally:
+                if self.frontend:
+                    self.unlink()
+
+
+class CapturePipe(object):
+    "Pipe wrapper that records every message (timestamped) to a session file"
+
+    def __init__(self, pipe, filename=None):
+        self.pipe = pipe
+        self.capture = open(filename, "wb") if filename else None
+        self.t0 = time.time()
+
+    def record(self, direction, data):
+        "Store a message (direction is 'send' or 'recv') with relative time"
+        if self.capture:
+            pickle.dump((time.time() - self.t0, direction, data),
+                        self.capture, pickle.HIGHEST_PROTOCOL)
+            self.capture.flush()
+
+    def send(self, data):
+        self.record("send", data)
+        self.pipe.send(data)
+
+    def recv(self, *args, **kwargs):
+        data = self.pipe.recv(*args, **kwargs)
+        self.record("recv", data)
+        return data
+
+    def poll(self, timeout=None):
+        if timeout is None:
+            return self.pipe.poll()
+        return self.pipe.poll(timeout)
+
+    def fileno(self):
+        "Descriptor of the wrapped connection (to wait it with select)"
+        return self.pipe.fileno()
+
+    def close(self):
+        if self.capture:
+            self.capture.close()
+            self.capture = None
+        self.pipe.close()
+
+
+class ReplayError(RuntimeError):
+    "The frontend diverged from the captured session (see ReplayPipe)"
+    pass
+
+
+class ReplayPipe(object):
+    "Simulated pipe that feeds a captured session (see CapturePipe)"
+
+    def __init__(self, filename, speed=None):
+        self.messages = []      # (timestamp, data) received by the frontend
+        self.requests = []      # captured requests (to match the sent ones)
+        self.ids = {}           # {captured request id: sent request id}
+        self.sent = []          # messages sent by the frontend
+        self.speed = speed      # None: full speed, 1.0: original timing
+        f = open(filename, "rb")
+        try:
+            while True:
+                try:
+                    timestamp, direction, data = pickle.load(f)
+                except EOFError:
+                    break
+                if direction == "recv":
+                    self.messages.append((timestamp, data))
+                elif data.get('method'):
+                    self.requests.append(data)
+        finally:
+            f.close()
+        self.t0 = None
+
+    def delay(self):
+        "Seconds to wait until the next message is due (original timing)"
+        if not self.speed or not self.messages:
+            return 0
+        if self.t0 is None:
+            # start the clock relative to the first message
+            self.t0 = time.time() - self.messages[0][0] / self.speed
+        return self.messages[0][0] / self.speed - (time.time() - self.t0)
+
+    def send(self, data):
+        self.sent.append(data)
+        if not data.get('method'):
+            return      # response to the backend (i.e. readline)
+        # the requests must be the same (and in the same order) as captured
+        if not self.requests:
+            raise ReplayError("%s not in the captured session" % 
+                              data['method'])
+        request = self.requests.pop(0)
+        if request['method'] != data['method']:
+            raise ReplayError("sent %s but %s was captured" % 
+                              (data['method'], request['method']))
+        if request.get('id'):
+            self.ids[request['id']] = data.get('id')
+
+    def is_sent(self):
+        "Check that the request of the next response was already sent"
+        data = self.messages[0][1]
+        return data.get('method') or not data.get('id') or \
+               data['id'] in self.ids
+
+    def recv(self, count=None, timeout=None):
+        if not self.messages:
+            raise EOFError("end of the captured session")
+        while not self.is_sent():
+            time.sleep(0.01)    # wait the frontend (i.e. user command)
+        wait = self.delay()
+        if wait > 0:
+            time.sleep(wait)
+        data = self.messages.pop(0)[1]
+        if not data.get('method') and data.get('id'):
+            # response: use the id of the request sent in this session
+            data = dict(data, id=self.ids.pop(data['id']))
+        return data
+
+    def poll(self, timeout=None):
+        t0 = time.time()
+        while self.messages:
+            if self.is_sent() and self.delay() <= 0:
+                return True
+            if not timeout or time.time() - t0 >= timeout:
+                return False
+            time.sleep(0.01)
+        # report EOF on next recv (as a closed connection does)
+        return True
+
+    def close(self):
+        self.messages = []
+
+
 class RPCError(RuntimeError):
     "Remote Error (not user exception)"
     pass
 
+
+class Future(object):
+    "Pending result of a remote call (see Frontend.call_async)"
+
+    def __init__(self, frontend, method, callback=None):
+        self.frontend = frontend
+        self.method = method
+        self.callback = callback    # called with this future when done
+        self.response = None
+
+    def done(self):
+        return self.response is not None
+
+    def set_response(self, response):
+        self.response = response
+        if self.callback:
+            self.callback(self)
+
+    def result(self):
+        "Wait the response (processing other messages) and return the value"
+        frontend = self.frontend
+        t0 = time.time()
+        while self.response is None:
+            if frontend.busy_interval:
+                # do not block forever (i.e. show the evaluation progress)
+                while not frontend.poll(frontend.busy_interval):
+                    frontend.busy(self.method, time.time() - t0)
+            # nested notifications, requests and other responses are
+            # processed until this response arrives 
+            frontend.process_message(frontend.recv())
+        if self.response.get('error'):
+            raise RPCError(self.response['error']['message'])
+        return self.response['result']
+
     
 class Frontend(object):
     "Qdb generic Frontend interface"
@@ -577,7 +1357,9 @@ class Frontend(object):
     def __init__(self, pipe):
         self.i = 1
         self.pipe = pipe
+        self.busy_interval = None   # seconds to wait before calling busy()
         self.notifies = []
+        self.futures = {}           # pending remote calls (by request id)
         self.read_lock = threading.RLock()
         self.write_lock = threading.RLock()
 
@@ -595,6 +1377,10 @@ class Frontend(object):
         finally:
             self.write_lock.release()
 
+    def poll(self, timeout=0.0):
+        "Check if a message is available (waiting up to timeout seconds)"
+        return self.pipe.poll(timeout)
+
     def startup(self):
         self.send({'method': 'run', 'args': (), 'id': None})
 
@@ -613,6 +1399,10 @@ class Frontend(object):
         "Console input/rawinput"
         raise NotImplementedError
 
+    def busy(self, method, elapsed):
+        "Remote call still running (i.e. evaluating), see busy_interval"
+        pass
+
     def run(self):
         "Main method dispatcher (infinite loop)"
         if self.pipe:
@@ -627,10 +1417,18 @@ class Frontend(object):
     def process_message(self, request):
         if request:
             result = None
-            if request.get("error"):
+            if request.get('id') and 'result' in request:
+                # response to a remote call, match it with the request
+                future = self.futures.pop(long(request['id']), None)
+                if future:
+                    future.set_response(request)
+                else:
+                    print "DEBUGGER unexpected response received: id", \
+                          request['id']
+            elif request.get("error"):
                 # it is not supposed to get an error here
                 # it should be raised by the method call
-                raise RPCError(res['error']['message'])
+                raise RPCError(request['error']['message'])
             elif request.get('method') == 'interaction':
                 self.interaction(*request.get("args"), **request.get("kwargs"))
             elif request.get('method') == 'startup':
@@ -649,26 +1447,21 @@ class Frontend(object):
             return True
 
     def call(self, method, *args):
-        "Actually call the remote method (inside the thread)"
-        req = {'method': method, 'args': args, 'id': self.i}
-        self.send(req)
-        self.i += 1  # increment the id
-        while 1:
-            # wait until command acknowledge (response id match the request)
-            res = self.recv()
-            if 'id' not in res or not res['id']:
-                # nested notification received (i.e. write)! process it!
-                self.process_message(res)
-            elif 'result' not in res:
-                # nested request received (i.e. readline)! process it!
-                self.process_message(res)
-            elif long(req['id']) != long(res['id']):
-                print "DEBUGGER wrong packet received: expecting id", req['id'], res['id']
-                # protocol state is unknown
-            elif 'error' in res and res['error']:
-                raise RPCError(res['error']['message'])
-            else:
-                return res['result']
+        "Actually call the remote method (waiting the result)"
+        return self.call_async(method, *args).result()
+
+    def call_async(self, method, *args, **kwargs):
+        "Send the request without waiting the response (returns a Future)"
+        future = Future(self, method, kwargs.get('callback'))
+        self.write_lock.acquire()
+        try:
+            req = {'method': method, 'args': args, 'id': self.i}
+            self.futures[self.i] = future
+            self.i += 1  # increment the id
+            self.send(req)
+        finally:
+            self.write_lock.release()
+        return future
 
     def do_step(self, arg=None):
         "Execute the current line, stop at the first possible occasion"
@@ -698,6 +1491,10 @@ class Frontend(object):
     def do_quit(self, arg=None):
         "Quit from the debugger. The program being executed is aborted."
         self.call('do_quit')
+
+    def do_detach(self, arg=None):
+        "Detach the debugger. The program being executed is resumed."
+        self.call('do_detach')
     
     def do_eval(self, expr):
         "Inspect the value of the expression"
@@ -730,6 +1527,22 @@ class Frontend(object):
     def do_list_breakpoint(self):
         "List all breakpoints"
         return self.call('do_list_breakpoint')
+
+    def do_set_watchpoint(self, expression):
+        "Stop when the expression value changes (in the current function)"
+        return self.call('do_set_watchpoint', expression)
+
+    def do_clear_watchpoint(self, expression=None):
+        "Remove a watchpoint (all watchpoints if no expression is given)"
+        self.call('do_clear_watchpoint', expression or None)
+
+    def do_list_watchpoint(self, arg=None):
+        "List all watchpoints"
+        return self.call('do_list_watchpoint')
+
+    def do_until(self, expression):
+        "Continue execution until the expression is true (current function)"
+        self.call('do_until', expression)
         
     def do_exec(self, statement):
         return self.call('do_exec', statement)
@@ -746,6 +1559,16 @@ class Frontend(object):
         req = {'method': 'interrupt', 'args': ()}
         self.send(req)
 
+    def cancel_eval(self):
+        "Interrupt the current evaluation (do_eval, do_exec, etc.)"
+        # this is a notification!, do not expect a response
+        req = {'method': 'cancel_eval', 'args': ()}
+        self.send(req)
+
+    def do_batch(self, commands):
+        "Run a list of commands in the backend (one round trip)"
+        return self.call('do_batch', commands)
+
     def set_burst(self, value):
         req = {'method': 'set_burst', 'args': (value, )}
         self.send(req)
@@ -754,6 +1577,11 @@ class Frontend(object):
         req = {'method': 'set_params', 'args': (params, )}
         self.send(req)
 
+    def set_exception_policy(self, policy):
+        "Rules to stop on exceptions: uncaught_only, include, exclude, ..."
+        req = {'method': 'set_exception_policy', 'args': (policy, )}
+        self.send(req)
+
 
 class Cli(Frontend, cmd.Cmd):
     "Qdb Front-end command line interface"
@@ -772,7 +1600,9 @@ class Cli(Frontend, cmd.Cmd):
                 print "Interupting..."
                 self.interrupt()
 
-    def interaction(self, filename, lineno, line):
+    def interaction(self, filename, lineno, line, **context):
+        if context.get('watch'):
+            print "watch %s: %s -> %s" % context['watch']
         print "> %s(%d)\n-> %s" % (filename, lineno, line),
         self.filename = filename
         self.cmdloop()
@@ -799,6 +1629,8 @@ class Cli(Frontend, cmd.Cmd):
     do_c = Frontend.do_continue        
     do_r = Frontend.do_return
     do_q = Frontend.do_quit
+    do_u = Frontend.do_until
+    do_wa = Frontend.do_set_watchpoint
 
     def do_eval(self, args):
         "Inspect the value of the expression"
@@ -842,6 +1674,21 @@ class Cli(Frontend, cmd.Cmd):
         else:
             self.do_list_breakpoint()
 
+    def do_list_watchpoint(self, arg=None):
+        "List all watchpoints"
+        for filename, function, expression, until, value in \
+                Frontend.do_list_watchpoint(self):
+            print "%s:%s %s %s = %s" % (filename, function, 
+                        "until" if until else "watch", expression, value)
+
+    def do_batch(self, args):
+        "Run a list of commands, i.e. [{'method': 'do_step', 'count': 10}]"
+        for i, response in enumerate(Frontend.do_batch(self, eval(args, {}, {}))):
+            if response['error']:
+                print "%d: *** %s" % (i, response['error']['message'])
+            else:
+                print "%d: %s" % (i, response['result'])
+
     def do_jump(self, args):
         "Jump to the selected line"
         ret = Frontend.do_jump(self, args)
@@ -920,6 +1767,80 @@ def test():
     sys.exit(0)
 
 
+def g(pipe, running):
+    "test function to be debugged (runs until the list is emptied)"
+    qdb_test = Qdb(pipe=pipe, redirect_stdio=False, allow_interruptions=True,
+                   skip=[])
+    qdb_test.set_trace()
+    while running:
+        time.sleep(0.01)
+
+
+def test_eval():
+    "Check the requests received while evaluating are not lost (watchdog)"
+    from threading import Thread
+    parent_queue, child_queue = Queue.Queue(), Queue.Queue()
+    front_conn = QueuePipe("parent", parent_queue, child_queue)
+    child_conn = QueuePipe("child", child_queue, parent_queue)
+    running = [True]
+    p = Thread(target=g, args=(child_conn, running))
+    p.daemon = True
+    p.start()
+
+    class Test(Frontend):
+        def interaction(self, *args, **kwargs):
+            pass
+        def readline(self):
+            time.sleep(1.5)     # slow user (more than the time budget)
+            return "input\n"
+
+    def wait(futures, timeout=5):
+        t0 = time.time()
+        while not all([future.done() for future in futures]):
+            assert time.time() - t0 < timeout, "deadlock: no response"
+            if qdb_test.poll(0.1):
+                qdb_test.process_message(qdb_test.recv())
+
+    qdb_test = Test(front_conn)
+    qdb_test.process_message(qdb_test.recv())       # first interaction
+    # nothing to cancel (the answer should not be lost):
+    future = qdb_test.call_async('cancel_eval')
+    wait([future])
+    assert future.result() is False
+    # requests received by the watchdog while evaluating are queued, they
+    # should be processed even if the program is resumed meanwhile:
+    future = qdb_test.call_async('do_eval', "__import__('time').sleep(1)")
+    time.sleep(0.2)
+    futures = [future, qdb_test.call_async('do_continue'),
+               qdb_test.call_async('do_list_breakpoint')]
+    wait(futures)
+    assert future.result() == 'None'
+    # waiting the user input does not count in the time budget:
+    wait([qdb_test.call_async('interrupt')])
+    qdb_test.process_message(qdb_test.recv())       # interrupted
+    wait([qdb_test.call_async('set_params', {'eval_timeout': 1})])
+    future = qdb_test.call_async('do_eval', "qdb_test.readline()")
+    wait([future])
+    assert future.result() == repr("input\n"), future.result()
+    # cancel a runaway evaluation:
+    future = qdb_test.call_async('do_eval', 
+                        "any(i < 0 for i in __import__('itertools').count())")
+    time.sleep(0.2)
+    cancel = qdb_test.call_async('cancel_eval')
+    wait([future, cancel])
+    assert cancel.result() is True
+    try:
+        future.result()
+    except RPCError, e:
+        assert "cancelled" in str(e)
+    else:
+        raise AssertionError("evaluation not cancelled")
+    running.pop()
+    qdb_test.do_continue()
+    p.join(5)
+    print "eval ok"
+
+
 def connect(host="localhost", port=6000, authkey='secret password'):
     "Connect to a running debugger backend"
     
@@ -938,7 +1859,7 @@ def connect(host="localhost", port=6000, authkey='secret password'):
         conn.close()
 
 
-def main(host='localhost', port=6000, authkey='secret password'):
+def main(host='localhost', port=6000, authkey='secret password', shm=None):
     "Debug a script and accept a remote frontend"
     
     if not sys.argv[1:] or sys.argv[1] in ("--help", "-h"):
@@ -955,11 +1876,16 @@ def main(host='localhost', port=6000, authkey='secret password'):
     # Replace pdb's dir with script's dir in front of module search path.
     sys.path[0] = os.path.dirname(mainpyfile)
 
-    from multiprocessing.connection import Client
-    address = (host, port)     # family is deduced to be 'AF_INET'
-    print "qdb debugger backend: waiting for connection to", address
-    conn = Client(address, authkey=authkey)
-    print 'qdb debugger backend: connected to', address
+    if shm:
+        # local frontend: use the shared memory created by it
+        conn = SharedMemoryPipe(shm)
+        print 'qdb debugger backend: using shared memory', shm
+    else:
+        from multiprocessing.connection import Client
+        address = (host, port)     # family is deduced to be 'AF_INET'
+        print "qdb debugger backend: waiting for connection to", address
+        conn = Client(address, authkey=authkey)
+        print 'qdb debugger backend: connected to', address
 
     # create the backend
     qdb = Qdb(conn, redirect_stdio=True, allow_interruptions=True)
@@ -980,11 +1906,10 @@ def main(host='localhost', port=6000, authkey='secret password'):
         print "Program terminated!"
     finally:
         conn.close()
-        listener.close()
         print "qdb debbuger backend: connection closed"
 
 
-qdb = None
+qdb = conn = listener = None
 def set_trace(host='localhost', port=6000, authkey='secret password'):
     "Simplified interface to debug running programs"
     global qdb, listener, conn
@@ -1002,6 +1927,99 @@ def set_trace(host='localhost', port=6000, authkey='secret password'):
     qdb.set_trace()
 
 
+agent = {}     # on-demand attach settings (see init)
+
+def init(host='localhost', port=6000, authkey='secret password', signum=None,
+         control_port=None, timeout=2):
+    "Install the on-demand attach agent (no tracing until it is requested)"
+    import signal
+    if signum is None:
+        signum = getattr(signal, "SIGUSR1", None)
+    agent.update(address=(host, int(port)), authkey=authkey, signum=signum,
+                 timeout=timeout)
+    if signum:
+        signal.signal(signum, attach)
+    elif not control_port:
+        # no signals to request the attach (windows), use the control socket
+        control_port = int(port) + 1
+    if control_port:
+        # optional control socket (i.e. if signals cannot be sent remotely)
+        t = threading.Thread(target=_control_loop, args=(int(control_port), ))
+        t.daemon = True
+        t.start()
+
+
+def attach(signum=None, frame=None):
+    "Connect to the IDE frontend and start tracing from the given frame"
+    global qdb, conn
+    if frame is None:
+        frame = sys._getframe().f_back
+    if not qdb or qdb.detached:
+        try:
+            conn = _connect(agent['address'], agent['authkey'], 
+                            agent['timeout'])
+        except Exception, e:
+            # do not disturb the running program (i.e. the IDE is not open)
+            print >> sys.stderr, "qdb agent: cannot attach to %s:%s:" % \
+                                 agent['address'], e
+            return
+        # do not redirect stdio nor poll the pipe (no overhead on continue)
+        qdb = Qdb(conn, redirect_stdio=False, detach_on_close=True)
+    qdb.set_trace(frame)
+
+
+def _connect(address, authkey, timeout):
+    "Open a connection to the frontend (without retrying, up to timeout)"
+    import socket
+    import _multiprocessing
+    from multiprocessing.connection import answer_challenge, deliver_challenge
+    s = socket.create_connection(address, timeout)
+    try:
+        # wait the challenge (a server that is not the IDE could not send it)
+        if not select.select([s], [], [], timeout)[0]:
+            raise IOError("no answer from %s:%s" % address)
+        s.setblocking(True)
+        c = _multiprocessing.Connection(os.dup(s.fileno()))
+    finally:
+        s.close()
+    try:
+        answer_challenge(c, authkey)
+        deliver_challenge(c, authkey)
+    except:
+        c.close()
+        raise
+    return c
+
+
+def _pending_attach(arg):
+    "Run attach in the main thread (as a signal handler does)"
+    attach(None, sys._getframe(1))
+    return 0
+
+if ctypes:
+    _pending_attach = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p)(
+                                                            _pending_attach)
+
+
+def _control_loop(port):
+    "Accept attach requests (forwarded to the main thread)"
+    from multiprocessing.connection import Listener
+    control = Listener(('localhost', port), authkey=agent['authkey'])
+    while True:
+        request = control.accept()
+        try:
+            if request.recv() != 'attach':
+                pass
+            elif agent['signum']:
+                os.kill(os.getpid(), agent['signum'])
+            elif ctypes:
+                ctypes.pythonapi.Py_AddPendingCall(_pending_attach, None)
+        except EOFError:
+            pass
+        finally:
+            request.close()
+
+
 def quit():
     "Remove trace and quit"
     global qdb, listener, conn
@@ -1019,14 +2037,18 @@ if __name__ == '__main__':
     # When invoked as main program:
     if '--test1' in sys.argv:
         test()
+    if '--test-eval' in sys.argv:
+        test_eval()
+        sys.exit(0)
     # Check environment for configuration parameters:
     kwargs = {}
-    for param in 'host', 'port', 'authkey':
+    for param in 'host', 'port', 'authkey', 'shm':
        if 'QDB_%s' % param.upper() in os.environ:
             kwargs[param] = os.environ['QDB_%s' % param.upper()]
 
     if not sys.argv[1:]:
         # connect to a remote debbuger
+        kwargs.pop('shm', None)
         connect(**kwargs)
     else:
         # start the debugger on a script
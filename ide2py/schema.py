@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"Tables of the IDE database (shared by the GUI and the benchmarks)"
+
+__author__ = "Mariano Reingart (reingart@gmail.com)"
+__copyright__ = "Copyright (C) 2014 Mariano Reingart"
+__license__ = "GPL 3.0"
+
+
+def create_task_tables(db):
+    "Create the structure for the task-based database (see task.py)"
+    db.create("task", task_id=int, task_name=str, task_uuid=str,
+                      repo_path=str, closed=bool, status=str,
+                      title=str, description=str, type=str,
+                      resolution=str, owner=str, assignee=str,
+                      started=str, completed=str, milestone=str,
+                      connector=str, organization=str, project=str)
+    db.create_search("task", "task_name", "title", "description")
+
+    db.create("context_file", context_file_id=int, task_id=int,
+                              filename=str, lineno=int, total_time=int,
+                              closed=bool,
+                              _unique=[("task_id", "filename")])
+    db.create("breakpoint", breakpoint_id=int, context_file_id=int,
+                            lineno=int, temp=bool, cond=str)
+    db.create("fold", fold_id=int, context_file_id=int, level=int,
+                      start_lineno=int, end_lineno=int, expanded=bool)
+
+
+def create_psp_tables(db):
+    "Create the PSP tables structure (see psp.py)"
+    db.create("defect", defect_id=int, task_id=int,
+                        number=int, summary=str, description=str,
+                        date=str, type=int, inject_phase=str, remove_phase=str,
+                        fix_time=float, fix_defect=int, checked=bool,
+                        filename=str, lineno=int, offset=int, uuid=str,
+                        _unique=[("task_id", "uuid")])
+    db.create_search("defect", "summary", "description")
+
+    db.create("time_summary", time_summary_id=int, task_id=int,
+                              phase=str, plan=float, actual=float,
+                              off_task=float, interruption=float,
+                              _unique=[("task_id", "phase")])
@@ -20,6 +20,7 @@ from wx.lib.scrolledpanel import ScrolledPanel
 
 import connector
 import images
+from schema import create_task_tables
 
 DEBUG = False
 
@@ -36,24 +37,12 @@ class TaskMixin(object):
         
         cfg = wx.GetApp().get_config("TASK")
         self.task_id = None
+        self.task = None            # keep the active record alive (cached)
         self.task_suspended = True
         
         # create the structure for the task-based database:
         self.db = wx.GetApp().get_db()
-        self.db.create("task", task_id=int, task_name=str, task_uuid=str,
-                               repo_path=str, closed=bool, status=str,
-                               title=str, description=str, type=str,
-                               resolution=str, owner=str, assignee=str,                               
-                               started=str, completed=str, milestone=str,
-                               connector=str, organization=str, project=str)    
-
-        self.db.create("context_file", context_file_id=int, task_id=int, 
-                                       filename=str, lineno=int, total_time=int,
-                                       closed=bool)
-        self.db.create("breakpoint", breakpoint_id=int, context_file_id=int, 
-                                     lineno=int, temp=bool, cond=str)
-        self.db.create("fold", fold_id=int, context_file_id=int, level=int, 
-                               start_lineno=int, end_lineno=int, expanded=bool)
+        create_task_tables(self.db)
         
         # internal structure to keep tracking times and other 
         self.task_context_files = {}
@@ -117,6 +106,15 @@ class TaskMixin(object):
         tb4.ToggleTool(ID_CHANGE, False)
         tb4.SetToolDropDown(ID_CHANGE, True)
         tb4.AddLabel(ID_TASK_LABEL, "create a task...", width=100)
+        self.task_search = wx.SearchCtrl(tb4, size=(150, -1), 
+                                         style=wx.TE_PROCESS_ENTER)
+        self.task_search.SetDescriptiveText("Search tasks...")
+        self.task_search.Bind(wx.EVT_TEXT_ENTER, self.OnSearchTasks)
+        if "task" not in self.db.search_tables:
+            # sqlite without full-text search (see create_search)
+            self.task_search.Hide()
+        elif WX_VERSION > (2, 8, 11): # TODO: prevent SEGV!
+            tb4.AddControl(self.task_search, "Search")
         tb4.Realize()
         self.task_toolbar = tb4
         return tb4
@@ -134,6 +132,37 @@ class TaskMixin(object):
             self.activate_task(task_name, task_id)
         dlg.Destroy()
 
+    def OnSearchTasks(self, event):
+        "Full-text search on tasks and defects, go to the selected one"
+        text = self.task_search.GetValue().strip()
+        if not text or "task" not in self.db.search_tables:
+            return
+        results = []
+        for row in self.db.search("task", text):
+            label = "Task %s: %s" % (row['task_name'], row['snippet'])
+            results.append((row['rank'], label, row['task_id'], None))
+        if "defect" in self.db.search_tables:
+            for row in self.db.search("defect", text):
+                label = "Defect #%s: %s" % (row['number'], row['snippet'])
+                results.append((row['rank'], label, row['task_id'], row))
+        if not results:
+            self.ShowInfoBar("no tasks or defects found for %s" % text,
+                             flags=wx.ICON_INFORMATION, key="task")
+            return
+        # sort by relevance (lower rank is better)
+        results.sort(key=lambda it: it[0])
+        choices = [" ".join(label.split()) for rank, label, t, d in results]
+        dlg = wx.SingleChoiceDialog(self, 'Results for "%s"' % text, 
+                                    'Task Search', choices, wx.CHOICEDLG_STYLE)
+        if dlg.ShowModal() == wx.ID_OK:
+            rank, label, task_id, defect = results[dlg.GetSelection()]
+            if task_id and task_id != self.task_id:
+                self.activate_task(None, task_id)
+            if defect and defect['filename']:
+                child = self.DoOpen(defect['filename'])
+                child.GotoLineOffset(defect['lineno'], defect['offset'] or 1)
+        dlg.Destroy()
+
     def OnDropDownChangeTask(self, event):
 
         if event.IsDropDownClicked():
@@ -196,41 +225,44 @@ class TaskMixin(object):
         kwargs['password'] = cfg.get("password")
         kwargs['organization'], kwargs['project'] = url.split("/")[3:5]
         gh = connector.GitHub(**kwargs)
-        for data in gh.list_tasks():
-            print data
-            task = self.db["task"](task_name=data['name'], 
-                                   organization=kwargs['organization'],
-                                   project=kwargs['project'],
-                                   description=data['description'],
-                                   type=data['type'],
-                                   resolution=data['resolution'],
-                                   started=data['started'],
-                                   owner=data['owner'], 
-                                   status=data['status'], 
-                                   ##assignee=data['assignee'],
-                                   connector="github")
-            if not task:
-                # add the new task
-                task = self.db["task"].new(task_name=data['name'], 
-                                           task_uuid=str(uuid.uuid1()),
-                                           connector="github",
-                                           organization=kwargs['organization'],
-                                           description=data['description'],
-                                           type=data['type'],
-                                           resolution=data['resolution'],
-                                           started=data['started'],
-                                           owner=data['owner'],
-                                           status=data['status'], 
-                                           ##assignee=data['assignee'],
-                                           project=kwargs['project'])
-                task.save()
-            # update the task
-            for k, v in data.items():
-                if k in task.keys():
-                    task[k] = v
-            task['closed'] = data['status']=='closed'
-            task.save()
-        self.db.commit()
+        # fetch all the tasks first (do not keep the transaction open)
+        tasks = list(gh.list_tasks())
+        # insert or update them atomically (all or nothing)
+        with self.db.transaction():
+            for data in tasks:
+                print data
+                task = self.db["task"](task_name=data['name'], 
+                                       organization=kwargs['organization'],
+                                       project=kwargs['project'],
+                                       description=data['description'],
+                                       type=data['type'],
+                                       resolution=data['resolution'],
+                                       started=data['started'],
+                                       owner=data['owner'], 
+                                       status=data['status'], 
+                                       ##assignee=data['assignee'],
+                                       connector="github")
+                if not task:
+                    # add the new task
+                    task = self.db["task"].new(task_name=data['name'], 
+                                               task_uuid=str(uuid.uuid1()),
+                                               connector="github",
+                                               organization=kwargs['organization'],
+                                               description=data['description'],
+                                               type=data['type'],
+                                               resolution=data['resolution'],
+                                               started=data['started'],
+                                               owner=data['owner'],
+                                               status=data['status'], 
+                                               ##assignee=data['assignee'],
+                                               project=kwargs['project'])
+                    task.save()
+                # update the task
+                for k, v in data.items():
+                    if k in task.keys():
+                        task[k] = v
+                task['closed'] = data['status']=='closed'
+                task.save(defer=True)   # written in batch on commit
 
     def activate_task(self, task_name=None, task_id=None):
         "Set task name in toolbar and uuid in config file"
@@ -257,7 +289,7 @@ class TaskMixin(object):
         if task:
             self.task_id = task['task_id']
             self.resume_task()
-            if DEBUG: print "TASK ID", self.task_id, task.data_in
+            if DEBUG: print "TASK ID", self.task_id, dict(task)
             self.preload_task(task)
 
     def set_task(self, task):
@@ -273,12 +305,13 @@ class TaskMixin(object):
                 wx.GetApp().config.remove_option('TASK', 'task_id')
             wx.GetApp().write_config()
         self.task_id = task_id
+        self.task = task
             
     def preload_task(self, task):
         # pre-load all task contexts (open an editor if necessary):
-        rows = self.db['context_file'].select(task_id=self.task_id)
-        # sort in the most relevant order (max total_time, reversed):
-        context_files = sorted(rows, key=lambda it: (-(it['total_time'] or 0)))
+        # query in the most relevant order (max total_time, reversed):
+        context_files = self.db['context_file'].query(task_id=self.task_id, 
+                                                      _order="-total_time")
         first = None
         for row in context_files:
             filename = row['filename']
@@ -360,22 +393,23 @@ class TaskMixin(object):
         ctx = self.get_task_context(filename)
         ctx['lineno'] = editor.GetCurrentLine()
         ctx['closed'] = not wx.GetApp().closing
-        ctx.save()
-        # remove all previous breakpoints and persist new ones:
-        self.db["breakpoint"].delete(context_file_id=ctx['context_file_id'])
-        for bp in editor.GetBreakpoints().values():
-            if DEBUG: print "saving breakpoint", filename, bp
-            bp = self.db["breakpoint"].new(**bp)
-            bp['context_file_id'] = ctx['context_file_id'] 
-            bp.save()
-        # remove all previous breakpoints and persist new ones:
-        self.db["fold"].delete(context_file_id=ctx['context_file_id'])
-        for fold in editor.GetFoldAll():
-            if DEBUG: print "saving fold", filename, fold['start_lineno']
-            fold = self.db["fold"].new(**fold)
-            fold['context_file_id'] = ctx['context_file_id'] 
-            fold.save()
-        self.db.commit()
+        # replace the context atomically (committed at the end of the block)
+        with self.db.transaction():
+            ctx.save()
+            # remove all previous breakpoints and persist new ones:
+            self.db["breakpoint"].delete(context_file_id=ctx['context_file_id'])
+            for bp in editor.GetBreakpoints().values():
+                if DEBUG: print "saving breakpoint", filename, bp
+                bp = self.db["breakpoint"].new(**bp)
+                bp['context_file_id'] = ctx['context_file_id'] 
+                bp.save(defer=True)
+            # remove all previous breakpoints and persist new ones:
+            self.db["fold"].delete(context_file_id=ctx['context_file_id'])
+            for fold in editor.GetFoldAll():
+                if DEBUG: print "saving fold", filename, fold['start_lineno']
+                fold = self.db["fold"].new(**fold)
+                fold['context_file_id'] = ctx['context_file_id'] 
+                fold.save(defer=True)
         
     def load_task_context(self, filename, editor):
         "Read and apply the record for this context file"